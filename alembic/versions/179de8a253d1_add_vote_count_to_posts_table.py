@@ -0,0 +1,34 @@
+"""add vote count to posts table
+
+Revision ID: 179de8a253d1
+Revises: f61b6ec13675
+Create Date: 2026-10-18 09:12:40.118305
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '179de8a253d1'
+down_revision = 'f61b6ec13675'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('posts', 
+                    sa.Column('vote_count', sa.Integer(), nullable=False, server_default='0'))
+    
+    # backfill the counter of existing posts from the votes table
+    op.execute("""
+        UPDATE posts SET vote_count = counts.votes
+        FROM (SELECT post_id, COUNT(*) AS votes FROM votes GROUP BY post_id) AS counts
+        WHERE posts.id = counts.post_id
+    """)
+    pass
+
+
+def downgrade():
+    op.drop_column('posts', 'vote_count')
+    pass
@@ -0,0 +1,33 @@
+"""add search vector to posts table
+
+Revision ID: 5e0b7d4c9a21
+Revises: 179de8a253d1
+Create Date: 2026-10-18 10:03:17.402611
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '5e0b7d4c9a21'
+down_revision = '179de8a253d1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # a stored generated column is computed for existing rows when it is added, so no backfill is needed
+    op.add_column('posts', 
+                    sa.Column('search_vector', postgresql.TSVECTOR(), 
+                                sa.Computed("to_tsvector('english', title || ' ' || content)", persisted=True)))
+    
+    op.create_index('ix_posts_search_vector', 'posts', ['search_vector'], postgresql_using='gin')
+    pass
+
+
+def downgrade():
+    op.drop_index('ix_posts_search_vector', table_name='posts')
+    op.drop_column('posts', 'search_vector')
+    pass
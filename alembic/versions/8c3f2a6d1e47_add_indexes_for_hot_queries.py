@@ -0,0 +1,43 @@
+"""add indexes for hot queries
+
+Revision ID: 8c3f2a6d1e47
+Revises: 5e0b7d4c9a21
+Create Date: 2026-10-18 14:21:05.734210
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c3f2a6d1e47'
+down_revision = '5e0b7d4c9a21'
+branch_labels = None
+depends_on = None
+
+# index name -> (table, columns)
+#   ix_posts_owner_id       posts of a user, and the cascade when a user is deleted
+#   ix_posts_created_at_id  newest first ordering and the keyset cursor of /posts/page
+#   ix_votes_post_id        votes of a post, and the cascade when a post is deleted. The (user_id, post_id) primary key cannot serve post_id alone
+INDEXES = {
+    'ix_posts_owner_id': ('posts', ['owner_id']),
+    'ix_posts_created_at_id': ('posts', ['created_at', 'id']),
+    'ix_votes_post_id': ('votes', ['post_id']),
+}
+
+
+def upgrade():
+    # CONCURRENTLY builds each index without locking out writes so this can run against a live database.
+    # It cannot run inside a transaction, hence the autocommit block.
+    # A concurrent build that fails leaves an INVALID index behind: drop it and run the migration again
+    with op.get_context().autocommit_block():
+        for name, (table, columns) in INDEXES.items():
+            op.create_index(name, table, columns, postgresql_concurrently=True)
+    pass
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, (table, columns) in INDEXES.items():
+            op.drop_index(name, table_name=table, postgresql_concurrently=True)
+    pass
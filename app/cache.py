@@ -0,0 +1,206 @@
+import threading
+import time
+from collections import OrderedDict
+from .config import settings
+
+# In-process caches used to keep hot lookups away from the database.
+# Each uvicorn worker process holds its own copy of a cache.
+
+
+class TTLCache:
+    '''
+    A thread safe, bounded cache. 
+    Entries expire after ttl seconds and the least recently used entry is evicted once maxsize is reached.
+    Hits and misses are counted so the cache can be monitored.
+    '''
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict() # key -> (expiry time, value). Ordered from least to most recently used
+        self._lock = threading.Lock() # sync path operations run in a threadpool
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl: float = None):
+        ''' Stores value under key. ttl overrides the cache's time to live for this entry only '''
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return None if entry is None else entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class ResponseCache:
+    '''
+    Interface of a cache of rendered responses.
+    Every entry is stored with tags, e.g. the ids of the posts it holds, and invalidating a tag drops every entry carrying it.
+    A reader takes the generation before it reads the database and passes it to set. Should a tag of the entry be invalidated
+    in between, the entry may hold data from before the write and set drops it.
+    The in-memory implementation below is the default. Subclass this to back the cache with an external store shared by all workers
+    '''
+    def get(self, key):
+        raise NotImplementedError
+
+    def generation(self):
+        raise NotImplementedError
+
+    def set(self, key, value, tags, generation=None):
+        raise NotImplementedError
+
+    def invalidate(self, tags):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def stats(self):
+        raise NotImplementedError
+
+
+class InMemoryResponseCache(ResponseCache):
+    '''
+    A thread safe, bounded ResponseCache held by the worker process.
+    Entries expire after ttl seconds so writes made through other workers show up eventually. A maxsize of 0 disables caching
+    '''
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._entries = OrderedDict() # key -> (expiry time, value, tags). Ordered from least to most recently used
+        self._keys_by_tag = {}
+        self._generation = 0 # bumped by every invalidate
+        self._tag_generations = {} # tag -> generation it was last invalidated in
+        self._oldest_generation = 0 # fills taken before this are dropped: _tag_generations forgot what came before
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                self._remove(key)
+            self.misses += 1
+            return None
+
+    def generation(self):
+        with self._lock:
+            return self._generation
+
+    def set(self, key, value, tags, generation=None):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            if generation is not None and self._invalidated_since(tags, generation):
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl, value, tags)
+            for tag in tags:
+                self._keys_by_tag.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, tags):
+        with self._lock:
+            self._generation += 1
+            for tag in tags:
+                self._tag_generations[tag] = self._generation
+                for key in self._keys_by_tag.get(tag, set()).copy():
+                    self._remove(key)
+                    self.invalidations += 1
+            # one generation is kept per invalidated tag. Past maxsize of them they are forgotten and older fills all dropped
+            if len(self._tag_generations) > self.maxsize:
+                self._tag_generations.clear()
+                self._oldest_generation = self._generation
+
+    def _invalidated_since(self, tags, generation):
+        if generation < self._oldest_generation:
+            return True
+        return any(self._tag_generations.get(tag, 0) > generation for tag in tags)
+
+    def _remove(self, key):
+        _, _, tags = self._entries.pop(key)
+        for tag in tags:
+            keys = self._keys_by_tag[tag]
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_tag[tag]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_tag.clear()
+            self._tag_generations.clear()
+            self._oldest_generation = self._generation
+            self.hits = 0
+            self.misses = 0
+            self.invalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "invalidations": self.invalidations,
+        }
+
+
+# Tags of the post response cache. 
+# Listing pages carry LIST_TAG, pages filtered by a search also carry SEARCH_TAG, and every entry carries post_tag(id) of each post it holds
+LIST_TAG = "posts"
+SEARCH_TAG = "search"
+
+def post_tag(id: int):
+    return f"post:{id}"
+
+# rendered post listing and detail responses, shared by the sync and async routers
+post_cache = InMemoryResponseCache(maxsize=settings.post_cache_size, ttl=settings.post_cache_ttl_seconds)
@@ -1,8 +1,13 @@
-from sqlalchemy import create_engine
+from fastapi import Request
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
 import psycopg2
 from psycopg2.extras import RealDictCursor
+import itertools
+import threading
 import time
 from .config import settings
 
@@ -11,8 +16,127 @@ from .config import settings
 # 'postgresql://:<password>@<ip-address/hostname>/<database_name>'
 
 SQL_ALCHEMY_DATABASE_URL = f'postgresql://{settings.database_username}:{settings.database_password}@{settings.database_hostname}:{settings.database_port}/{settings.database_name}'
+
+
+class PoolMetrics:
+    ''' Running totals of an engine's connection pool. Served by the /metrics/pool endpoint '''
+    def __init__(self):
+        self.checkouts = 0
+        self.checkins = 0
+        self.timeouts = 0 # checkouts which gave up after pool_timeout seconds
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self._lock = threading.Lock() # the sync engine checks connections out and in from the threadpool
+
+    def checked_out(self):
+        with self._lock:
+            self.checkouts += 1
+
+    def checked_in(self):
+        with self._lock:
+            self.checkins += 1
+
+    def waited(self, seconds: float, timed_out: bool):
+        with self._lock:
+            self.timeouts += timed_out
+            self.wait_seconds_total += seconds
+            self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "checkouts": self.checkouts,
+                "checkins": self.checkins,
+                "timeouts": self.timeouts,
+                "wait_seconds_total": self.wait_seconds_total,
+                "wait_seconds_max": self.wait_seconds_max,
+            }
+
+class TimedPoolMixin:
+    '''
+    Times how long each checkout waits for a free connection, which no pool event reports.
+    Overrides the private QueuePool._do_get, as of the pinned SQLAlchemy==1.4.0: check it still exists when upgrading
+    '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = PoolMetrics()
+
+    def _do_get(self):
+        start = time.perf_counter()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            timed_out = True
+            raise
+        finally:
+            self.metrics.waited(time.perf_counter() - start, timed_out)
+
+    def recreate(self):
+        # engine.dispose() swaps in a new pool. Keep counting where the old one left off
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        return pool
+
+class TimedQueuePool(TimedPoolMixin, QueuePool):
+    pass
+
+class TimedAsyncAdaptedQueuePool(TimedPoolMixin, AsyncAdaptedQueuePool):
+    pass
+
+# connection pool settings shared by every engine. SQLAlchemy's defaults are pool_size=5, max_overflow=10 and no pre-ping or recycle
+POOL_OPTIONS = {
+    "pool_size": settings.database_pool_size,
+    "max_overflow": settings.database_max_overflow,
+    "pool_timeout": settings.database_pool_timeout,
+    "pool_recycle": settings.database_pool_recycle,
+    "pool_pre_ping": settings.database_pool_pre_ping,
+}
+
+# The request deadline is applied to every statement as Postgres' statement_timeout. It is set once when a connection is opened,
+# so it costs no round trip per request. A statement running longer is cancelled by the server with SQLSTATE 57014 (query_canceled),
+# which main.py answers with a 503 and frees the connection for other requests
+def connect_args(timeout_seconds: float):
+    return {"options": f"-c statement_timeout={int(timeout_seconds * 1000)}"}
+
+def async_connect_args(timeout_seconds: float):
+    # asyncpg takes server settings rather than libpq options
+    return {"server_settings": {"statement_timeout": str(int(timeout_seconds * 1000))}}
+
+CONNECT_ARGS = connect_args(settings.request_timeout_seconds)
+ASYNC_CONNECT_ARGS = async_connect_args(settings.request_timeout_seconds)
+
+# engines whose pools are reported by pool_stats, by name
+engines = {}
+
+def register_engine(name: str, engine):
+    ''' Counts checkouts and checkins of an engine's pool with pool event listeners '''
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        engine.pool.metrics.checked_out()
+
+    def on_checkin(dbapi_connection, connection_record):
+        engine.pool.metrics.checked_in()
+
+    event.listen(engine, "checkout", on_checkout)
+    event.listen(engine, "checkin", on_checkin)
+    engines[name] = engine
+
+def pool_stats():
+    stats = {}
+    for name, engine in engines.items():
+        pool = engine.pool
+        stats[name] = {
+            "size": pool.size(),
+            "max_overflow": settings.database_max_overflow,
+            "checked_out": pool.checkedout(),
+            "overflow": max(pool.overflow(), 0), # QueuePool counts unopened connections of the pool as negative overflow
+            **pool.metrics.snapshot(),
+        }
+    return stats
+
 # create engine to talk to the database
-engine = create_engine(SQL_ALCHEMY_DATABASE_URL)
+engine = create_engine(SQL_ALCHEMY_DATABASE_URL, poolclass=TimedQueuePool, connect_args=CONNECT_ARGS, **POOL_OPTIONS)
+register_engine("primary", engine)
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
@@ -26,6 +150,85 @@ def get_db():
     finally:
         db.close()
 
+# Async engine used when settings.database_async is on. asyncpg is only needed in that case.
+# Each in-flight request then holds a pooled connection instead of a threadpool thread
+ASYNC_SQL_ALCHEMY_DATABASE_URL = SQL_ALCHEMY_DATABASE_URL.replace('postgresql://', 'postgresql+asyncpg://', 1)
+
+async_engine = None
+if settings.database_async:
+    async_engine = create_async_engine(ASYNC_SQL_ALCHEMY_DATABASE_URL, poolclass=TimedAsyncAdaptedQueuePool, 
+                                        connect_args=ASYNC_CONNECT_ARGS, **POOL_OPTIONS)
+    register_engine("primary_async", async_engine.sync_engine)
+
+# expire_on_commit is off as an AsyncSession cannot lazy load attributes expired by a commit
+AsyncSessionLocal = sessionmaker(bind=async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+# Dependency for creating an async database session
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+# Read replicas. Read-only path operations take their session from get_read_db, which spreads them across 
+# the replicas in turn. Without replicas configured every session comes from the primary
+replica_engines = []
+ReplicaSessionLocals = []
+AsyncReplicaSessionLocals = []
+for number, url in enumerate(settings.database_replica_urls):
+    replica_engine = create_engine(url, poolclass=TimedQueuePool, connect_args=CONNECT_ARGS, **POOL_OPTIONS)
+    register_engine(f"replica_{number}", replica_engine)
+    replica_engines.append(replica_engine)
+    ReplicaSessionLocals.append(sessionmaker(autocommit=False, autoflush=False, bind=replica_engine))
+    if settings.database_async:
+        async_replica_engine = create_async_engine(url.replace('postgresql://', 'postgresql+asyncpg://', 1), 
+                                                    poolclass=TimedAsyncAdaptedQueuePool, connect_args=ASYNC_CONNECT_ARGS, **POOL_OPTIONS)
+        register_engine(f"replica_{number}_async", async_replica_engine.sync_engine)
+        AsyncReplicaSessionLocals.append(sessionmaker(bind=async_replica_engine, class_=AsyncSession, 
+                                                        autoflush=False, expire_on_commit=False))
+
+# Replicas lag behind the primary. A client which has just written reads from the primary for a while so it sees its own writes.
+# main.py sets this cookie, holding the time until which reads stay on the primary, on every successful write request
+PRIMARY_UNTIL_COOKIE = "primary_until"
+
+replica_counter = itertools.count()
+
+def reads_from_primary(request: Request):
+    try:
+        return float(request.cookies.get(PRIMARY_UNTIL_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+def reads_from_replica(request: Request):
+    ''' Whether get_read_db (get_async_read_db) serves the request from a replica '''
+    return bool(replica_engines) and not reads_from_primary(request)
+
+def pick_read_sessionmaker(request: Request, primary, replicas):
+    if not replicas or reads_from_primary(request):
+        return primary
+    return replicas[next(replica_counter) % len(replicas)]
+
+# Dependency for creating a database session for read-only path operations
+def get_read_db(request: Request):
+    db = pick_read_sessionmaker(request, SessionLocal, ReplicaSessionLocals)()
+    try:
+        yield db
+    finally:
+        db.close()
+
+async def get_async_read_db(request: Request):
+    async with pick_read_sessionmaker(request, AsyncSessionLocal, AsyncReplicaSessionLocals)() as db:
+        yield db
+
+
+# Postgres error codes (SQLSTATE) the routers handle
+FOREIGN_KEY_VIOLATION = "23503"
+QUERY_CANCELED = "57014" # statement_timeout reached, or cancelled on request
+
+def pgcode(error: exc.DBAPIError):
+    ''' SQLSTATE of a database error raised through psycopg2 or asyncpg '''
+    orig = error.orig
+    # psycopg2 errors carry pgcode. The asyncpg adapter wraps the asyncpg error, which carries sqlstate
+    return getattr(orig, "pgcode", None) or getattr(orig.__cause__, "sqlstate", None)
+
 
 
 # while True:
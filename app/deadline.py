@@ -0,0 +1,159 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from fastapi import Request, status
+from fastapi.responses import ORJSONResponse, Response
+from sqlalchemy import event, exc
+from . import database, metrics
+from .config import settings
+
+# Request deadlines and cancellation.
+# Every statement is bounded by settings.request_timeout_seconds through Postgres' statement_timeout (see database.py).
+# A statement cut off by it fails with SQLSTATE 57014, answered by query_canceled_handler with a 503.
+# A client that disconnects before its response is sent does not wait for its queries to finish either:
+#   async path operations   the request's task is cancelled, which makes asyncpg cancel the running query
+#   sync path operations    they run in the threadpool and cannot be interrupted, so their running queries are cancelled
+#                           on the server (psycopg2 connection.cancel) and fail with 57014. The cancel requests are sent
+#                           from cancel_executor, not the threadpool, which is the very thing short of threads under load
+# Requests given up this way are recorded with the non-standard status 499 (client closed request)
+
+CLIENT_CLOSED_REQUEST = 499
+
+
+class RequestState:
+    def __init__(self):
+        self.disconnected = False
+        self.connections = set() # DBAPI connections running a statement for the request
+        self._lock = threading.Lock() # statements start and end in the threadpool, and are cancelled from cancel_executor
+
+    def started(self, connection):
+        with self._lock:
+            self.connections.add(connection)
+
+    def finished(self, connection):
+        with self._lock:
+            self.connections.discard(connection)
+
+    def cancel_queries(self):
+        '''
+        Cancels the statements still running for the request.
+        A connection leaves the set before it can go back to the pool, and the lock is held from checking the set to cancelling,
+        so a connection already handed on to another request is never cancelled
+        '''
+        with self._lock:
+            for connection in self.connections:
+                connection.cancel()
+
+
+# The RequestState of the request being served. Shared with the threadpool like timing.request_timings
+request_state: ContextVar[RequestState] = ContextVar("request_state", default=None)
+
+
+def instrument_engine(engine):
+    ''' Tracks which connections run a statement for the current request, so they can be cancelled when the client leaves '''
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        state = request_state.get()
+        if state is not None:
+            state.started(conn.connection.connection)
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        state = request_state.get()
+        if state is not None:
+            state.finished(conn.connection.connection)
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(exception_context):
+        state = request_state.get()
+        if state is not None and exception_context.connection is not None:
+            state.finished(exception_context.connection.connection.connection)
+
+
+# connection.cancel opens a connection to Postgres and waits for it to take the cancel request
+cancel_executor = ThreadPoolExecutor(max_workers=settings.query_cancel_workers, thread_name_prefix="query-cancel")
+
+
+class CancelOnDisconnectMiddleware:
+    '''
+    ASGI middleware cancelling the work of a request whose client has disconnected.
+    It reads the request body itself and hands it on to the app, so it listens for the disconnect from the start of every request,
+    whether or not the path operation reads the body (FastAPI never calls receive for a GET)
+    '''
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        state = RequestState()
+        token = request_state.set(state)
+        task = asyncio.current_task()
+        disconnected = asyncio.Event()
+        response_sent = False
+        cancelled = False
+
+        async def send_response(message):
+            nonlocal response_sent
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                response_sent = True
+            await send(message)
+
+        try:
+            messages = [await receive()]
+            while messages[-1]["type"] == "http.request" and messages[-1].get("more_body", False):
+                messages.append(await receive())
+            if messages[-1]["type"] == "http.disconnect":
+                # gone before the whole request arrived. Nothing to cancel yet
+                state.disconnected = True
+                metrics.client_disconnects_total.inc()
+                return await Response(status_code=CLIENT_CLOSED_REQUEST)(scope, receive, send)
+
+            async def receive_request():
+                if messages:
+                    return messages.pop(0)
+                # the body has been handed on. The only message left is the disconnect, received by watch_for_disconnect
+                await disconnected.wait()
+                return {"type": "http.disconnect"}
+
+            async def watch_for_disconnect():
+                nonlocal cancelled
+                while (await receive())["type"] != "http.disconnect":
+                    pass
+                disconnected.set()
+                if response_sent:
+                    return
+                state.disconnected = True
+                metrics.client_disconnects_total.inc()
+                if settings.database_async:
+                    cancelled = True
+                    task.cancel()
+                else:
+                    await asyncio.get_running_loop().run_in_executor(cancel_executor, state.cancel_queries)
+
+            watcher = asyncio.ensure_future(watch_for_disconnect())
+            try:
+                await self.app(scope, receive_request, send_response)
+            except asyncio.CancelledError:
+                if not cancelled:
+                    raise
+                # the client is gone. Nothing sent here reaches it, the status is only for the timing log and metrics
+                await Response(status_code=CLIENT_CLOSED_REQUEST)(scope, receive, send)
+            finally:
+                watcher.cancel()
+        finally:
+            request_state.reset(token)
+
+
+async def query_canceled_handler(request: Request, error: exc.DBAPIError):
+    ''' Answers statements cut off by statement_timeout with a 503. Other database errors are left to the 500 handler '''
+    if database.pgcode(error) != database.QUERY_CANCELED:
+        raise error
+    state = request_state.get()
+    if state is not None and state.disconnected:
+        return Response(status_code=CLIENT_CLOSED_REQUEST)
+    metrics.statement_timeouts_total.inc()
+    return ORJSONResponse({"detail": "The request took too long to process"}, status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                          headers={"Retry-After": "1"})
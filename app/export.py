@@ -0,0 +1,51 @@
+import csv
+import io
+from datetime import datetime
+from enum import Enum
+import orjson
+from fastapi.responses import StreamingResponse
+
+# Streaming exports of whole tables, served by /posts/export and /users/export.
+# Rows are read from a server-side cursor (stream_results) in batches of settings.export_batch_size
+# and each batch is written out before the next one is fetched, so memory stays flat whatever the size of the table.
+# The database session stays open until the response is sent as FastAPI closes it after the response.
+
+class ExportFormat(str, Enum):
+    ndjson = "ndjson" # one json object per line
+    csv = "csv"       # with a header row
+
+MEDIA_TYPES = {ExportFormat.ndjson: "application/x-ndjson", ExportFormat.csv: "text/csv"}
+
+
+def csv_value(value):
+    # same datetime format as the json responses
+    return value.isoformat() if isinstance(value, datetime) else value
+
+def render_rows(rows, fields, format: ExportFormat):
+    if format == ExportFormat.ndjson:
+        return b"".join(orjson.dumps(dict(zip(fields, row))) + b"\n" for row in rows)
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows([csv_value(value) for value in row] for row in rows)
+    return buffer.getvalue().encode()
+
+def render_header(fields, format: ExportFormat):
+    return render_rows([fields], fields, format) if format == ExportFormat.csv else b""
+
+
+def export_rows(batches, fields, format: ExportFormat):
+    ''' Renders batches of rows (Result.partitions) chunk by chunk '''
+    yield render_header(fields, format)
+    for rows in batches:
+        yield render_rows(rows, fields, format)
+
+async def export_rows_async(batches, fields, format: ExportFormat):
+    ''' export_rows for the batches of an AsyncResult '''
+    yield render_header(fields, format)
+    async for rows in batches:
+        yield render_rows(rows, fields, format)
+
+
+def export_response(batches, fields, format: ExportFormat, name: str):
+    rows = export_rows_async(batches, fields, format) if hasattr(batches, "__aiter__") else export_rows(batches, fields, format)
+    return StreamingResponse(rows, media_type=MEDIA_TYPES[format],
+                             headers={"Content-Disposition": f'attachment; filename="{name}.{format.value}"'})
@@ -1,15 +1,27 @@
 # FAST API processes requests in order. It finds the first method that matches then the matching url: "/"
 # Fundamentally an API is a bunch of path operations.
 
-from fastapi import FastAPI
+import time
+from fastapi import FastAPI, Request
+from fastapi.responses import ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
+from sqlalchemy import exc
 # from .database import engine
-from .routers import post, user, auth, vote
-from .config import Settings
+from . import database, deadline, timing
+from .config import Settings, settings
+from .routers import metrics
+
+# the async routers run on the async engine. The sync ones run in the threadpool. Both serve the same API
+if settings.database_async:
+    from .routers.aio import post, user, auth, vote
+else:
+    from .routers import post, user, auth, vote
 
 # models.Base.metadata.create_all(bind=engine) # No longer needed now that Alembic now handles migrations
 
-app = FastAPI()
+# orjson renders responses several times faster than the standard library json module
+app = FastAPI(default_response_class=ORJSONResponse)
+app.router.route_class = timing.TimedRoute
 
 # CORS policy (CORS = Cross Origin Resource Sharing)
 origins = ["*"]
@@ -25,10 +37,34 @@ app.add_middleware(
 # specify which requests the API can accept
 # specify the headers API can accept
 
+# Keep a client's reads on the primary database for a few seconds after it writes, until the replicas have caught up.
+# Only needed when read replicas are configured
+if database.ReplicaSessionLocals:
+    @app.middleware("http")
+    async def read_from_primary_after_write(request: Request, call_next):
+        response = await call_next(request)
+        if request.method not in ("GET", "HEAD", "OPTIONS") and response.status_code < 400:
+            sticky_seconds = settings.database_replica_sticky_seconds
+            response.set_cookie(database.PRIMARY_UNTIL_COOKIE, str(time.time() + sticky_seconds), 
+                                max_age=sticky_seconds, httponly=True)
+        return response
+
+# Statements cut off by the request deadline are answered with a 503. Work of clients which disconnect is cancelled
+app.add_exception_handler(exc.DBAPIError, deadline.query_canceled_handler)
+app.add_middleware(deadline.CancelOnDisconnectMiddleware)
+for engine in database.engines.values():
+    deadline.instrument_engine(engine)
+
+# Server-Timing header and timing log line for every request. Added last so it is the outermost middleware and times everything else
+app.add_middleware(timing.TimingMiddleware)
+for engine in database.engines.values():
+    timing.instrument_engine(engine)
+
 app.include_router(post.router)
 app.include_router(user.router)
 app.include_router(auth.router)
 app.include_router(vote.router)
+app.include_router(metrics.router)
 
 # base path operation
 @app.get("/") # decorator
@@ -0,0 +1,137 @@
+from bisect import bisect_left
+
+# Prometheus metrics, rendered in the text exposition format by GET /metrics.
+# Requests are observed by timing.TimingMiddleware, which runs on the event loop thread of the worker,
+# so the counters are plain python numbers updated without locks. Every uvicorn worker keeps and serves its own counters.
+# Gauges and counters of the pools, caches and bcrypt executor are read from them when /metrics is scraped.
+
+# seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{str(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {} if labels else {(): 0} # label values -> count. A counter without labels starts at 0
+
+    def inc(self, label_values=(), amount: float = 1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for label_values, value in self.values.items():
+            lines.append(f"{self.name}{format_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {} # label values -> [count per bucket (the last one is +Inf), sum]
+
+    def observe(self, label_values, value: float):
+        series = self.series.get(label_values)
+        if series is None:
+            series = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for label_values, (counts, total) in self.series.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                labels = format_labels((*self.labels, "le"), (*label_values, bound))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+def sampled(kind: str, name: str, help: str, labels=(), values=None):
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+    for label_values, value in (values or {}).items():
+        lines.append(f"{name}{format_labels(labels, label_values)} {value}")
+    return lines
+
+
+def gauge(name: str, help: str, labels=(), values=None):
+    ''' Renders a gauge from a {label values: value} dict read at scrape time '''
+    return sampled("gauge", name, help, labels, values)
+
+
+def counter(name: str, help: str, labels=(), values=None):
+    ''' Renders a counter kept elsewhere (by the pools, caches, executors) from a {label values: value} dict read at scrape time '''
+    return sampled("counter", name, help, labels, values)
+
+
+requests_total = Counter("http_requests_total", "HTTP requests by route template and status code",
+                            labels=("method", "route", "status"))
+request_duration = Histogram("http_request_duration_seconds", "HTTP request latency by route template",
+                            labels=("method", "route"))
+request_db_duration = Histogram("http_request_db_seconds", "Time spent in SQL statements per request",
+                            labels=("method", "route"))
+db_statements_total = Counter("db_statements_total", "SQL statements executed by route template",
+                            labels=("method", "route"))
+statement_timeouts_total = Counter("db_statement_timeouts_total", "Requests answered with a 503 as a statement ran past the request deadline")
+client_disconnects_total = Counter("http_client_disconnects_total", "Requests given up as the client disconnected before the response")
+
+
+def observe_request(method: str, route: str, status_code: int, seconds: float, db_seconds: float, statements: int):
+    # requests that match no route are labelled together so unknown paths cannot blow up the number of series
+    route = route or "unmatched"
+    requests_total.inc((method, route, status_code))
+    request_duration.observe((method, route), seconds)
+    request_db_duration.observe((method, route), db_seconds)
+    db_statements_total.inc((method, route), statements)
+
+
+def render():
+    # imported here as the routers import this module through timing
+    from . import cache, database, oauth2, utils
+
+    lines = []
+    for metric in (requests_total, request_duration, request_db_duration, db_statements_total,
+                    statement_timeouts_total, client_disconnects_total):
+        lines += metric.render()
+
+    pools = database.pool_stats()
+    for render_metric, key, name, help in [
+        (gauge, "size", "db_pool_size", "Connections kept open by the pool"),
+        (gauge, "checked_out", "db_pool_checked_out", "Connections currently in use"),
+        (gauge, "overflow", "db_pool_overflow", "Connections open beyond the pool size"),
+        (counter, "checkouts", "db_pool_checkouts_total", "Connections handed out by the pool"),
+        (counter, "timeouts", "db_pool_timeouts_total", "Checkouts that gave up waiting for a connection"),
+        (counter, "wait_seconds_total", "db_pool_wait_seconds_total", "Time spent waiting for a connection"),
+    ]:
+        lines += render_metric(name, help, ("engine",), {(engine,): stats[key] for engine, stats in pools.items()})
+
+    caches = {"posts": cache.post_cache.stats(), "users": oauth2.user_cache.stats(), "tokens": oauth2.token_cache.stats()}
+    for render_metric, key, name, help in [
+        (gauge, "size", "cache_entries", "Entries held by the cache"),
+        (counter, "hits", "cache_hits_total", "Cache lookups answered from the cache"),
+        (counter, "misses", "cache_misses_total", "Cache lookups that missed"),
+    ]:
+        lines += render_metric(name, help, ("cache",), {(cache_name,): stats[key] for cache_name, stats in caches.items()})
+
+    bcrypt = utils.bcrypt_executor
+    lines += gauge("bcrypt_in_flight", "Password hashes running or queued", values={(): bcrypt.in_flight})
+    lines += gauge("bcrypt_capacity", "Password hashes admitted at once (workers + queue)",
+                    values={(): bcrypt.max_workers + bcrypt.max_queue})
+    lines += counter("bcrypt_rejected_total", "Password hashes rejected with a 503 as the queue was full",
+                    values={(): bcrypt.rejected})
+    return "\n".join(lines) + "\n"
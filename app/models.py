@@ -1,7 +1,8 @@
 from email.policy import default
-from sqlalchemy import TIMESTAMP, Column, ForeignKey, Integer, String, Boolean
+from sqlalchemy import TIMESTAMP, Column, Computed, ForeignKey, Index, Integer, String, Boolean
+from sqlalchemy.dialects.postgresql import TSVECTOR
 from sqlalchemy.sql.expression import text
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import deferred, relationship
 from .database import Base
 
 # These classes will create the respective tables in the database
@@ -15,9 +16,18 @@ class Post(Base):
     published = Column(Boolean, server_default='TRUE', nullable=False)
     created_at = Column(TIMESTAMP(timezone=True), 
                             nullable=False, server_default=text('now()')) # server default means the database server is the one to create timestamp entry with default value of now
-    owner_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    owner_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True)
+    vote_count = Column(Integer, nullable=False, server_default='0') # denormalized count of votes. Kept in step with the votes table by the vote router
+    # full-text search document of the post. Generated and stored by the database whenever title or content change.
+    # deferred so it is never loaded along with a post. It is only used in WHERE and ORDER BY clauses
+    search_vector = deferred(Column(TSVECTOR, Computed("to_tsvector('english', title || ' ' || content)", persisted=True)))
     
     owner = relationship("User")     # automatically figures out relationship btw classes, creates an owner property, returns the sqlalchemy class. 
+
+    __table_args__ = (
+        Index('ix_posts_search_vector', 'search_vector', postgresql_using='gin'),
+        Index('ix_posts_created_at_id', 'created_at', 'id'), # newest first listing and its keyset cursor
+    )
    
 class User(Base):
     __tablename__ = "users"
@@ -31,5 +41,5 @@ class User(Base):
 class Vote(Base):
     __tablename__ = "votes"
     user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
-    post_id = Column(Integer, ForeignKey("posts.id", ondelete="CASCADE"), primary_key=True)
+    post_id = Column(Integer, ForeignKey("posts.id", ondelete="CASCADE"), primary_key=True, index=True) # the primary key only serves lookups by user_id first
     
\ No newline at end of file
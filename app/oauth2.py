@@ -1,9 +1,12 @@
 from jose import JWTError, jwt
 from datetime import datetime, timedelta
+import time
 from fastapi import Depends, status, HTTPException
 from fastapi.security import OAuth2PasswordBearer
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from . import schemas, database, models
+from . import schemas, database, models, cache, timing
 from .config import settings
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl='login') # the string login here is from the login endpoint i.e. /login path operation
@@ -17,19 +20,58 @@ ALGORITHM = settings.algorithm
 # specify time to expiration of token
 ACCESS_TOKEN_EXPIRE_MINUTES = settings.access_token_expire_minutes
 
+try:
+    import jwt as pyjwt # optional. Only needed with JWT_BACKEND=pyjwt
+except ImportError:
+    pyjwt = None
+
+# JWT backends. PyJWT decodes the same HS256 tokens as python-jose. In tests/benchmarks/bench_jwt.py the two are within noise
+# of each other; the saving on verification comes from token_cache below (30-80x faster than decoding), not from the backend.
+# Tokens signed by either backend verify with the other, so the backend can be switched without logging users out
+def jose_encode(claims: dict):
+    return jwt.encode(claims, SECRET_KEY, algorithm=ALGORITHM)
+
+def jose_decode(token: str):
+    return jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+
+def pyjwt_encode(claims: dict):
+    return pyjwt.encode(claims, SECRET_KEY, algorithm=ALGORITHM)
+
+def pyjwt_decode(token: str):
+    try:
+        return pyjwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except pyjwt.PyJWTError as error:
+        raise JWTError(str(error))
+
+JWT_BACKENDS = {"jose": (jose_encode, jose_decode), "pyjwt": (pyjwt_encode, pyjwt_decode)}
+if settings.jwt_backend == "pyjwt" and pyjwt is None:
+    raise RuntimeError("JWT_BACKEND=pyjwt needs PyJWT installed: pip install PyJWT")
+encode_jwt, decode_jwt = JWT_BACKENDS[settings.jwt_backend]
+
+# verified tokens -> TokenData. A token is decoded and its signature checked once instead of on every request.
+# Entries expire with their token so an expired token is never accepted from the cache
+token_cache = cache.TTLCache(maxsize=settings.token_cache_size, ttl=settings.token_cache_ttl_seconds)
+
+# users' rows keyed by user id. Saves a database round trip on every authenticated request
+user_cache = cache.TTLCache(maxsize=settings.user_cache_size, ttl=settings.user_cache_ttl_seconds)
+
 def create_access_token(data: dict):
     to_encode = data.copy() # create copy of the data to be put in the token
 
     expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES) # token expiration time to end session 
     to_encode.update({"exp": expire})
 
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    encoded_jwt = encode_jwt(to_encode)
     
     return encoded_jwt
 
 def verify_access_token(token: str, credentials_exception):
+    token_data = token_cache.get(token)
+    if token_data is not None:
+        return token_data
+
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = decode_jwt(token)
         id: str = payload.get("user_id")
         if id is None:
             raise credentials_exception
@@ -38,17 +80,65 @@ def verify_access_token(token: str, credentials_exception):
     
     except JWTError:
         raise credentials_exception
-    
+
+    # only valid tokens are cached. Garbage tokens cannot push them out
+    expires_in = payload["exp"] - time.time() if "exp" in payload else token_cache.ttl
+    if expires_in > 0:
+        token_cache.set(token, token_data, ttl=min(expires_in, token_cache.ttl))
     return token_data
 
+async def get_current_principal(token: str = Depends(oauth2_scheme)):
+    '''
+    The current user built from the token's claims. No database query is run.
+    Path operations which only need current_user.id depend on this. The few that need the user's row opt in to get_current_user
+    '''
+    credentials_exception = HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, 
+                                            detail=f"Could not validate credentials", headers={"WWW-Authenticate": "Bearer"})
+
+    # async so it runs on the event loop instead of taking a threadpool thread. Verified tokens are cached so this is cheap
+    with timing.phase("auth"):
+        token = verify_access_token(token, credentials_exception)
+        return schemas.Principal(id=token.id)
+
 def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(database.get_db)):
     credentials_exception = HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, 
                                             detail=f"Could not validate credentials", headers={"WWW-Authenticate": "Bearer"})
     
-    # alternative implementation to fetching user from db in every path operation
-    token = verify_access_token(token, credentials_exception) 
-    
-    user = db.query(models.User).filter(models.User.id == token.id).first()
+    with timing.phase("auth"):
+        # alternative implementation to fetching user from db in every path operation
+        token = verify_access_token(token, credentials_exception) 
+        
+        user_id = int(token.id)
+        user = user_cache.get(user_id)
+        if user is None:
+            user = db.query(models.User).filter(models.User.id == user_id).first()
+            if user is not None:
+                # detach the row from this session so it stays readable after the session commits or closes
+                db.expunge(user)
+                user_cache.set(user_id, user)
     # with former implementation return verify_access_token(token, credentials_exception)
     return user
 
+async def get_current_user_async(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(database.get_async_db)):
+    ''' Version of get_current_user for async path operations. Shares the same cache of users' rows '''
+    credentials_exception = HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, 
+                                            detail=f"Could not validate credentials", headers={"WWW-Authenticate": "Bearer"})
+    
+    with timing.phase("auth"):
+        token = verify_access_token(token, credentials_exception) 
+        
+        user_id = int(token.id)
+        user = user_cache.get(user_id)
+        if user is None:
+            user = await db.get(models.User, user_id)
+            if user is not None:
+                db.expunge(user)
+                user_cache.set(user_id, user)
+    return user
+
+# drop a user's cached row whenever it is changed or deleted through the ORM
+@event.listens_for(models.User, "after_update")
+@event.listens_for(models.User, "after_delete")
+def invalidate_cached_user(mapper, connection, target):
+    user_cache.pop(target.id)
+
@@ -0,0 +1,23 @@
+import base64
+import json
+from datetime import datetime
+
+# Keyset (cursor) pagination helpers.
+# Rather than skipping over `offset` rows, a cursor remembers the sort key of the last row
+# a client has seen, so the next page starts with an indexed range condition i.e.
+# WHERE (created_at, id) < (:created_at, :id). Page 10,000 then costs the same as page 1.
+# The cursor is opaque to clients: a base64 encoded json array of the sort key.
+
+
+def encode_cursor(created_at: datetime, id: int) -> str:
+    raw = json.dumps([created_at.isoformat(), id]).encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+
+def decode_cursor(cursor: str):
+    ''' Returns the (created_at, id) pair held in a cursor. Raises ValueError if the cursor is malformed '''
+    try:
+        created_at, id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(created_at), int(id)
+    except (TypeError, ValueError) as error: # json.JSONDecodeError and binascii.Error are both ValueErrors
+        raise ValueError(f"invalid cursor: {cursor}") from error
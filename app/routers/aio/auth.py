@@ -0,0 +1,27 @@
+from fastapi import APIRouter, Depends, status, HTTPException
+from fastapi.security.oauth2 import OAuth2PasswordRequestForm
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ... import database, schemas, models, utils, oauth2, timing
+
+# Async version of the login path operation in routers/auth.py. Served when settings.database_async is on.
+
+router = APIRouter(tags=['Authentication'], route_class=timing.TimedRoute)
+
+
+# login endpoint
+@router.post('/login', response_model=schemas.Token)
+async def login(user_credentials: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(database.get_async_db)):
+    # username_credentials.username is an email
+
+    user = (await db.execute(select(models.User).filter(models.User.email == user_credentials.username))).scalar_one_or_none()
+    # user login validation
+    if not user:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=f"Invalid Credentials") # no user in database with that email
+
+    if not await utils.verify_async(user_credentials.password, user.password):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=f"Invalid Credentials") # wrong password
+
+    access_token = oauth2.create_access_token(data = {"user_id": user.id})
+    return {"access_token": access_token, "token_type": "bearer"}
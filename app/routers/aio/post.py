@@ -0,0 +1,134 @@
+from fastapi import status, Request, Response, HTTPException, Depends, APIRouter, Query
+from fastapi.responses import ORJSONResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload
+from typing import List, Optional
+from sqlalchemy import cast, func, select, tuple_
+from ... import models, schemas, oauth2, pagination, cache, timing, export
+from ...config import settings
+from ...database import get_async_db, get_async_read_db
+from ..post import (search_query, cached_response, cache_response, listing_tags, voted_post_dict, EXPORT_FIELDS, export_statement,
+                    bulk_insert_statement, post_response_dict, check_bulk_size, update_statement, delete_statement,
+                    owner_statement, write_missed)
+
+# Async versions of the path operations in routers/post.py. Served when settings.database_async is on.
+# An AsyncSession cannot lazy load, so every query returning posts also loads their owners (joinedload)
+
+router = APIRouter(
+    prefix="/posts",
+    tags=['Posts'],
+    route_class=timing.TimedRoute
+)
+
+def select_posts():
+    return select(models.Post, models.Post.vote_count.label("votes")).options(joinedload(models.Post.owner))
+
+@router.get("/", response_model=List[schemas.PostVoted])
+async def get_posts(request: Request, db: AsyncSession = Depends(get_async_read_db), current_user: schemas.Principal = Depends(oauth2.get_current_principal),
+                limit: int = 10, skip: int = 0, search: Optional[str] = ""):
+    key = ("posts", limit, skip, search)
+    response, generation = cached_response(request, key)
+    if response is not None:
+        return response
+
+    query = select_posts()
+    if search:
+        ts_query = search_query(search)
+        query = query.filter(models.Post.search_vector.op('@@')(ts_query)).order_by(
+                                                func.ts_rank(models.Post.search_vector, ts_query).desc(), models.Post.id)
+    posts = (await db.execute(query.limit(limit).offset(skip))).all()
+    return cache_response(request, key, [voted_post_dict(post) for post in posts], listing_tags(posts, search), generation)
+
+@router.get("/page", response_model=schemas.PostPage)
+async def get_posts_page(request: Request, db: AsyncSession = Depends(get_async_read_db), current_user: schemas.Principal = Depends(oauth2.get_current_principal),
+                limit: int = Query(10, ge=1, le=100), after: Optional[str] = None, search: Optional[str] = ""):
+    key = ("page", limit, after, search)
+    response, generation = cached_response(request, key)
+    if response is not None:
+        return response
+
+    query = select_posts()
+    if search:
+        query = query.filter(models.Post.search_vector.op('@@')(search_query(search)))
+    if after:
+        try:
+            created_at, post_id = pagination.decode_cursor(after)
+        except ValueError:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid cursor: {after}")
+        # asyncpg binds parameters by the type postgres infers for them. Inside a row comparison that is a timestamp without time zone
+        query = query.filter(tuple_(models.Post.created_at, models.Post.id) < tuple_(
+                                                cast(created_at, models.Post.created_at.type), post_id))
+
+    posts = (await db.execute(query.order_by(models.Post.created_at.desc(), models.Post.id.desc()).limit(limit + 1))).all()
+    next_cursor = None
+    if len(posts) > limit:
+        posts = posts[:limit]
+        last_post = posts[-1].Post
+        next_cursor = pagination.encode_cursor(last_post.created_at, last_post.id)
+
+    page = {"items": [voted_post_dict(post) for post in posts], "next_cursor": next_cursor}
+    return cache_response(request, key, page, listing_tags(posts, search), generation)
+
+@router.get("/export")
+async def export_posts(db: AsyncSession = Depends(get_async_read_db), current_user: schemas.Principal = Depends(oauth2.get_current_principal),
+                format: export.ExportFormat = export.ExportFormat.ndjson):
+    result = await db.stream(export_statement())
+    return export.export_response(result.partitions(settings.export_batch_size), EXPORT_FIELDS, format, "posts")
+
+@router.get("/{id}", response_model=schemas.PostVoted)
+async def get_post(request: Request, id: int, db: AsyncSession = Depends(get_async_read_db), current_user: schemas.Principal = Depends(oauth2.get_current_principal)):
+    key = ("post", id)
+    response, generation = cached_response(request, key)
+    if response is not None:
+        return response
+
+    post = (await db.execute(select_posts().filter(models.Post.id == id))).one_or_none()
+    if not post:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"post with id: {id} was not found" )
+    return cache_response(request, key, voted_post_dict(post), {cache.post_tag(id)}, generation)
+
+async def load_post(db: AsyncSession, id: int):
+    ''' Reloads a post and its owner after a commit. Replaces db.refresh, which leaves the owner to a lazy load '''
+    query = select(models.Post).options(joinedload(models.Post.owner)).filter(
+                                                models.Post.id == id).execution_options(populate_existing=True)
+    return (await db.execute(query)).scalar_one()
+
+@router.post("/", status_code=status.HTTP_201_CREATED, response_model=schemas.PostResponse)
+async def create_posts(post: schemas.PostCreate, db: AsyncSession = Depends(get_async_db), current_user: schemas.Principal = Depends(oauth2.get_current_principal)):
+    new_post = models.Post(owner_id=current_user.id, **post.dict())
+    db.add(new_post)
+    await db.commit()
+    cache.post_cache.invalidate([cache.LIST_TAG])
+    return await load_post(db, new_post.id)
+
+@router.post("/bulk", status_code=status.HTTP_201_CREATED, response_model=List[schemas.PostResponse])
+async def create_posts_bulk(posts: List[schemas.PostCreate], db: AsyncSession = Depends(get_async_db), current_user: schemas.Principal = Depends(oauth2.get_current_principal)):
+    check_bulk_size(posts)
+    if not posts:
+        return []
+
+    rows = (await db.execute(bulk_insert_statement(posts, current_user.id))).all()
+    await db.commit()
+    cache.post_cache.invalidate([cache.LIST_TAG])
+    with timing.phase("serialization"):
+        return ORJSONResponse(content=[post_response_dict(row) for row in rows], status_code=status.HTTP_201_CREATED)
+
+@router.put("/{id}", response_model=schemas.PostResponse)
+async def update_post(id: int, updated_post: schemas.PostCreate, db: AsyncSession = Depends(get_async_db), current_user: schemas.Principal = Depends(oauth2.get_current_principal)):
+    post = (await db.execute(update_statement(id, current_user.id, updated_post.dict()))).one_or_none()
+    if post is None:
+        raise write_missed(id, (await db.execute(owner_statement(id))).scalar())
+
+    await db.commit()
+    cache.post_cache.invalidate([cache.post_tag(id), cache.SEARCH_TAG])
+    return post_response_dict(post)
+
+@router.delete("/{id}", status_code=status.HTTP_204_NO_CONTENT)
+async def delete_post(id: int, db: AsyncSession = Depends(get_async_db), current_user: schemas.Principal = Depends(oauth2.get_current_principal)):
+    deleted = (await db.execute(delete_statement(id, current_user.id))).one_or_none()
+    if deleted is None:
+        raise write_missed(id, (await db.execute(owner_statement(id))).scalar())
+    await db.commit()
+    cache.post_cache.invalidate([cache.post_tag(id), cache.LIST_TAG])
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
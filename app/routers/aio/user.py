@@ -0,0 +1,68 @@
+from fastapi import status, HTTPException, Depends, APIRouter, Query
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List, Optional
+from ... import models, schemas, oauth2, utils, timing, export
+from ...config import settings
+from ...database import get_async_db, get_async_read_db
+from ..user import (EXPORT_FIELDS, export_statement, count_cache, COUNT_ESTIMATE, COUNT, page_size, users_after)
+
+# Async versions of the path operations in routers/user.py. Served when settings.database_async is on.
+
+router = APIRouter(
+    prefix="/users",
+    tags=['Users'],
+    route_class=timing.TimedRoute
+)
+
+@router.post("/", status_code=status.HTTP_201_CREATED, response_model=schemas.UserOut)
+async def create_user(user: schemas.UserCreate, db: AsyncSession = Depends(get_async_db)):
+
+    # hash the password on the bcrypt pool. The event loop keeps serving other requests meanwhile
+    user.password = await utils.hash_async(user.password)
+
+    new_user = models.User(**user.dict())
+    db.add(new_user)
+    await db.commit()
+    await db.refresh(new_user)
+
+    return new_user
+
+@router.get("/", response_model=List[schemas.UserOut])
+async def get_users(db: AsyncSession = Depends(get_async_read_db), limit: int = Query(10, ge=1), after: Optional[int] = None):
+
+    users = (await db.execute(select(models.User).filter(*users_after(after)).order_by(models.User.id)
+                                .limit(page_size(limit)))).scalars().all()
+    return users
+
+@router.get("/count", response_model=schemas.UserCount)
+async def count_users(db: AsyncSession = Depends(get_async_read_db)):
+    result = count_cache.get("users")
+    if result is None:
+        estimate = (await db.execute(COUNT_ESTIMATE)).scalar()
+        if estimate >= 0:
+            result = {"count": estimate, "estimated": True}
+        else:
+            result = {"count": (await db.execute(COUNT)).scalar(), "estimated": False}
+        count_cache.set("users", result)
+    return result
+
+@router.get("/export")
+async def export_users(db: AsyncSession = Depends(get_async_read_db), format: export.ExportFormat = export.ExportFormat.ndjson):
+    result = await db.stream(export_statement())
+    return export.export_response(result.partitions(settings.export_batch_size), EXPORT_FIELDS, format, "users")
+
+@router.get("/me", response_model=schemas.UserOut)
+async def get_me(current_user: models.User = Depends(oauth2.get_current_user_async)):
+    if current_user is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User does not exist")
+    return current_user
+
+@router.get("/{id}", response_model=schemas.UserOut)
+async def get_user(id: int, db: AsyncSession = Depends(get_async_read_db)):
+    user = await db.get(models.User, id)
+    if not user:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"User with id: {id} does not exist")
+
+    return user
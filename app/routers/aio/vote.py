@@ -0,0 +1,57 @@
+from fastapi import status, HTTPException, Depends, APIRouter
+from sqlalchemy import exc
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List
+from ... import database, schemas, oauth2, cache, timing
+from ..vote import (add_vote_statement, remove_vote_statement, post_not_found, add_votes_statement, remove_votes_statement,
+                    lock_posts_statement, check_batch_size, split_batch, batch_results)
+
+# Async version of the vote path operation in routers/vote.py. Served when settings.database_async is on.
+
+router = APIRouter(
+    prefix="/vote",
+    tags=["Vote"],
+    route_class=timing.TimedRoute
+)
+
+@router.post("/", status_code=status.HTTP_201_CREATED)
+async def vote(vote: schemas.Vote, db: AsyncSession = Depends(database.get_async_db), current_user: schemas.Principal = Depends(oauth2.get_current_principal)):
+
+    if (vote.dir == 1):
+        try:
+            voted = (await db.execute(add_vote_statement(vote.post_id, current_user.id))).first()
+            await db.commit()
+        except exc.IntegrityError as error:
+            await db.rollback()
+            if database.pgcode(error) == database.FOREIGN_KEY_VIOLATION:
+                raise post_not_found(vote.post_id)
+            raise
+        if not voted:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"user {current_user.id} has already voted on post {vote.post_id}")
+        # cached responses holding the post show its old vote count
+        cache.post_cache.invalidate([cache.post_tag(vote.post_id)])
+        return {"message": "successfully added vote"}
+
+    else:
+        removed = (await db.execute(remove_vote_statement(vote.post_id, current_user.id))).first()
+        await db.commit()
+        if not removed:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Vote does not exist")
+        cache.post_cache.invalidate([cache.post_tag(vote.post_id)])
+
+        return {"message": "successfully deleted vote"}
+
+@router.post("/batch", response_model=List[schemas.VoteResult])
+async def vote_batch(votes: List[schemas.Vote], db: AsyncSession = Depends(database.get_async_db), current_user: schemas.Principal = Depends(oauth2.get_current_principal)):
+    check_batch_size(votes)
+    if not votes:
+        return []
+    add_ids, remove_ids = split_batch(votes)
+
+    existing = set((await db.execute(lock_posts_statement(add_ids + remove_ids))).scalars())
+    added = set((await db.execute(add_votes_statement(add_ids, current_user.id))).scalars()) if add_ids else set()
+    removed = set((await db.execute(remove_votes_statement(remove_ids, current_user.id))).scalars()) if remove_ids else set()
+    await db.commit()
+
+    cache.post_cache.invalidate([cache.post_tag(post_id) for post_id in added | removed])
+    return batch_results(votes, current_user.id, added, removed, existing)
@@ -2,9 +2,9 @@ from fastapi import APIRouter, Depends, status, HTTPException, Response
 from fastapi.security.oauth2 import OAuth2PasswordRequestForm
 from sqlalchemy.orm import Session
 
-from .. import database, schemas, models, utils, oauth2
+from .. import database, schemas, models, utils, oauth2, timing
 
-router = APIRouter(tags=['Authentication']) 
+router = APIRouter(tags=['Authentication'], route_class=timing.TimedRoute) 
 
 
 # login endpoint
@@ -0,0 +1,26 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+from .. import database, cache, oauth2, timing, metrics
+
+router = APIRouter(
+    prefix="/metrics",
+    tags=['Metrics'],
+    route_class=timing.TimedRoute
+)
+
+@router.get("", response_class=PlainTextResponse)
+async def get_metrics():
+    # Prometheus scrape endpoint: request latency histograms per route template, pool, cache and bcrypt gauges.
+    # Each worker process answers with its own counters
+    return metrics.render()
+
+@router.get("/pool")
+async def get_pool_metrics():
+    # Connection pool usage of each database engine. 
+    # checked_out and overflow are current values, the rest are totals since the process started
+    return database.pool_stats()
+
+@router.get("/cache")
+async def get_cache_metrics():
+    # Hit ratio and size of the in-process caches
+    return {"posts": cache.post_cache.stats(), "users": oauth2.user_cache.stats(), "tokens": oauth2.token_cache.stats()}
@@ -1,17 +1,147 @@
-from fastapi import status, Response, HTTPException, Depends, APIRouter
-from sqlalchemy.orm import Session
+from fastapi import status, Request, Response, HTTPException, Depends, APIRouter, Query
+from fastapi.responses import ORJSONResponse
+from sqlalchemy.orm import Session, joinedload
 from typing import List, Optional
-from sqlalchemy import func
-from .. import models, schemas, oauth2
-from ..database import get_db
+from sqlalchemy import delete, func, insert, literal_column, select, tuple_, update
+from .. import database, models, schemas, oauth2, pagination, cache, timing, export
+from ..config import settings
+from ..database import get_db, get_read_db
 
 router = APIRouter(
     prefix="/posts",
-    tags=['Posts']
+    tags=['Posts'],
+    route_class=timing.TimedRoute
 )
 
+def search_query(search: str):
+    ''' 
+    Returns the full-text query for a search term. 
+    websearch_to_tsquery accepts free text from users (quoted phrases, 'or', -excluded words) without syntax errors
+    '''
+    # the text search configuration is rendered inline. Postgres will not cast a bound varchar parameter to regconfig
+    return func.websearch_to_tsquery(literal_column("'english'"), search)
+
+# Listing and detail responses are cached, rendered, in cache.post_cache.
+# Entries are tagged with the posts they hold and the write path operations (and votes) drop exactly the entries they affect.
+# Only responses read from the primary are cached: a replica may not have caught up with a write that has just invalidated them.
+# A client reading its own writes from the primary (database.reads_from_primary) neither reads nor fills the cache,
+# whose entries may predate its write
+def cached_response(request: Request, key):
+    ''' Returns the cached response, or None and the cache generation to pass to cache_response once the database has been read '''
+    if database.reads_from_primary(request):
+        return None, None
+    body = cache.post_cache.get(key)
+    if body is not None:
+        return Response(content=body, media_type="application/json"), None
+    return None, cache.post_cache.generation()
+
+def cache_response(request: Request, key, content, tags, generation):
+    ''' Renders content with orjson and caches the rendered body '''
+    with timing.phase("serialization"):
+        response = ORJSONResponse(content=content)
+    if generation is not None and not database.reads_from_replica(request):
+        cache.post_cache.set(key, response.body, tags, generation)
+    return response
+
+# Serialization fast path of the post responses.
+# Rows are turned straight into the dicts of schemas.PostVoted, skipping the validation of pydantic orm_mode models and jsonable_encoder.
+# orjson renders the datetimes in the same ISO 8601 format pydantic does. These must be kept in step with the schemas
+def post_dict(post: models.Post):
+    owner = post.owner
+    return {
+        "title": post.title,
+        "content": post.content,
+        "published": post.published,
+        "id": post.id,
+        "created_at": post.created_at,
+        "owner_id": post.owner_id,
+        "owner": {"id": owner.id, "email": owner.email, "created_at": owner.created_at},
+    }
+
+def voted_post_dict(row):
+    return {"Post": post_dict(row.Post), "votes": row.votes}
+
+def select_posts(db: Session):
+    '''
+    Query of posts with their vote counts. 
+    Owners are loaded in the same statement through a join. Left lazy, rendering a page would run one more SELECT per owner
+    '''
+    return db.query(models.Post, models.Post.vote_count.label("votes")).options(joinedload(models.Post.owner))
+
+# columns of the post exports, flat so they fit a csv row
+EXPORT_COLUMNS = [models.Post.id, models.Post.title, models.Post.content, models.Post.published,
+                    models.Post.created_at, models.Post.owner_id, models.Post.vote_count.label("votes")]
+EXPORT_FIELDS = ["id", "title", "content", "published", "created_at", "owner_id", "votes"]
+
+def export_statement():
+    return select(*EXPORT_COLUMNS).order_by(models.Post.id).execution_options(stream_results=True)
+
+# Writes returning posts. The statement writing the posts also returns them with their owner:
+#   WITH new_posts AS (INSERT INTO posts ... VALUES (...), (...) RETURNING ...)
+#   SELECT new_posts.*, users.email, users.created_at FROM new_posts JOIN users ON users.id = new_posts.owner_id
+# so no post needs a refresh or a lazy load of its owner afterwards
+RETURNED_COLUMNS = [models.Post.id, models.Post.title, models.Post.content, models.Post.published,
+                    models.Post.created_at, models.Post.owner_id]
+
+def select_with_owner(written_posts):
+    return select(written_posts, models.User.email.label("owner_email"), models.User.created_at.label("owner_created_at")) \
+                .join(models.User, models.User.id == written_posts.c.owner_id).order_by(written_posts.c.id)
+
+def bulk_insert_statement(posts: List[schemas.PostCreate], owner_id: int):
+    # bulk creation of posts, for importers
+    new_posts = insert(models.Post).values([{**post.dict(), "owner_id": owner_id} for post in posts]) \
+                .returning(*RETURNED_COLUMNS).cte("new_posts")
+    return select_with_owner(new_posts)
+
+def update_statement(id: int, owner_id: int, values: dict):
+    # only matches the post if the user owns it, so the ownership check needs no SELECT beforehand
+    updated_post = update(models.Post).where(models.Post.id == id, models.Post.owner_id == owner_id).values(**values) \
+                .returning(*RETURNED_COLUMNS).cte("updated_post")
+    return select_with_owner(updated_post)
+
+def delete_statement(id: int, owner_id: int):
+    return delete(models.Post).where(models.Post.id == id, models.Post.owner_id == owner_id).returning(models.Post.id) \
+                .execution_options(synchronize_session=False)
+
+def owner_statement(id: int):
+    return select(models.Post.owner_id).where(models.Post.id == id)
+
+def write_missed(id: int, owner_id: Optional[int]):
+    '''
+    The error of an update or delete which matched no post: the post does not exist (404) or belongs to someone else (403).
+    Looked up only when the write misses
+    '''
+    if owner_id is None:
+        return HTTPException(status_code=status.HTTP_404_NOT_FOUND, 
+                            detail=f"post with id: {id} does not exist")
+    return HTTPException(status_code=status.HTTP_403_FORBIDDEN, 
+                            detail=f"Not authorised to perform requested action")
+
+def post_response_dict(row):
+    ''' schemas.PostResponse of a row of select_with_owner '''
+    return {
+        "title": row.title,
+        "content": row.content,
+        "published": row.published,
+        "id": row.id,
+        "created_at": row.created_at,
+        "owner_id": row.owner_id,
+        "owner": {"id": row.owner_id, "email": row.owner_email, "created_at": row.owner_created_at},
+    }
+
+def check_bulk_size(posts: List[schemas.PostCreate]):
+    if len(posts) > settings.post_bulk_max_size:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                            detail=f"At most {settings.post_bulk_max_size} posts can be created at once")
+
+def listing_tags(posts, search: str):
+    tags = {cache.LIST_TAG, *(cache.post_tag(post.Post.id) for post in posts)}
+    if search:
+        tags.add(cache.SEARCH_TAG)
+    return tags
+
 @router.get("/", response_model=List[schemas.PostVoted]) # e.g /posts, /users (Convention. Always plural.)
-def get_posts(db: Session = Depends(get_db), current_user: object = Depends(oauth2.get_current_user),
+def get_posts(request: Request, db: Session = Depends(get_read_db), current_user: schemas.Principal = Depends(oauth2.get_current_principal),
                 limit: int = 10, skip: int = 0, search: Optional[str] = ""):
     # With current_user as dependency, this fxn will run only if the user has been authenticated i.e. has a token
     # This is optional. Not critical in all apps. For example users may see other users posts/tweets without logging in on Twitter through a web search 
@@ -20,32 +150,85 @@ def get_posts(db: Session = Depends(get_db), current_user: object = Depends(oaut
     # Skip is pagination it determines how many results should be 'skipped over'
     # Search provides search functionality on keywords in posts.
     
-    posts = db.query(models.Post, func.count(models.Vote.user_id).label("votes") ).join(                    # A join in sqlalchemy by default is a left inner join so there is need to specify which join should be made
-                                                models.Vote, models.Vote.post_id == models.Post.id, isouter=True).group_by(
-                                                models.Post.id).filter(models.Post.title.contains(search)).limit(limit).offset(skip).all()
-    return posts
+    key = ("posts", limit, skip, search)
+    response, generation = cached_response(request, key)
+    if response is not None:
+        return response
+
+    # votes are read from the denormalized vote_count column so listing posts no longer aggregates the votes table
+    query = select_posts(db)
+    # search matches the words of title and content through the GIN index on search_vector. Best matches come first.
+    # An empty search skips the predicate entirely
+    if search:
+        ts_query = search_query(search)
+        query = query.filter(models.Post.search_vector.op('@@')(ts_query)).order_by(
+                                                func.ts_rank(models.Post.search_vector, ts_query).desc(), models.Post.id)
+    posts = query.limit(limit).offset(skip).all()
+    return cache_response(request, key, [voted_post_dict(post) for post in posts], listing_tags(posts, search), generation)
+
+@router.get("/page", response_model=schemas.PostPage)
+def get_posts_page(request: Request, db: Session = Depends(get_read_db), current_user: schemas.Principal = Depends(oauth2.get_current_principal),
+                limit: int = Query(10, ge=1, le=100), after: Optional[str] = None, search: Optional[str] = ""):
+    # Cursor (keyset) pagination mode of get_posts. Posts are returned newest first.
+    # After is the next_cursor of the previous page. Omit it to fetch the first page.
+    # Unlike skip, the database seeks straight to the cursor so deep pages cost the same as the first page
+    
+    key = ("page", limit, after, search)
+    response, generation = cached_response(request, key)
+    if response is not None:
+        return response
+
+    query = select_posts(db)
+    if search:
+        query = query.filter(models.Post.search_vector.op('@@')(search_query(search)))
+    if after:
+        try:
+            created_at, post_id = pagination.decode_cursor(after)
+        except ValueError:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid cursor: {after}")
+        query = query.filter(tuple_(models.Post.created_at, models.Post.id) < tuple_(created_at, post_id))
+
+    # fetch one row more than requested to find out if there is a next page without a count query
+    posts = query.order_by(models.Post.created_at.desc(), models.Post.id.desc()).limit(limit + 1).all()
+    next_cursor = None
+    if len(posts) > limit:
+        posts = posts[:limit]
+        last_post = posts[-1].Post
+        next_cursor = pagination.encode_cursor(last_post.created_at, last_post.id)
+
+    page = {"items": [voted_post_dict(post) for post in posts], "next_cursor": next_cursor}
+    return cache_response(request, key, page, listing_tags(posts, search), generation)
+
+@router.get("/export")
+def export_posts(db: Session = Depends(get_read_db), current_user: schemas.Principal = Depends(oauth2.get_current_principal),
+                format: export.ExportFormat = export.ExportFormat.ndjson):
+    # Streams every post as NDJSON or CSV for bulk consumers, instead of paging through the listing.
+    # Rows go straight from a server-side cursor to the client, batch by batch
+    result = db.execute(export_statement())
+    return export.export_response(result.partitions(settings.export_batch_size), EXPORT_FIELDS, format, "posts")
 
 @router.get("/{id}", response_model=schemas.PostVoted)
-def get_post(id: int, db: Session = Depends(get_db), current_user: object = Depends(oauth2.get_current_user)):
+def get_post(request: Request, id: int, db: Session = Depends(get_read_db), current_user: schemas.Principal = Depends(oauth2.get_current_principal)):
     #  With current_user as dependency, this fxn will run only if the user has been authenticated i.e. has a token
     #  This is optional. Not critical in all apps. For example users may see other users posts/tweets without logging in on Twitter through a web search 
     
-    post = db.query(models.Post, func.count(models.Vote.user_id).label("votes")).join(                    # A join in sqlalchemy by default is a left inner join so there is need to specify which join should be made
-                                                models.Vote, models.Vote.post_id == models.Post.id, isouter=True).group_by(
-                                                models.Post.id).filter(models.Post.id == id).first()   
+    key = ("post", id)
+    response, generation = cached_response(request, key)
+    if response is not None:
+        return response
+
+    # a single primary key lookup. The owner is joined in and the vote count is read off the post row
+    post = select_posts(db).filter(models.Post.id == id).one_or_none()
     
     #post = db.query(models.Post).filter(models.Post.id == id).first()
     if not post:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f"post with id: {id} was not found" )
 
-    posts = db.query(models.Post, func.count(models.Vote.user_id).label("votes")).join(                    # A join in sqlalchemy by default is a left inner join so there is need to specify which join should be made
-                                                models.Vote, models.Vote.post_id == models.Post.id, isouter=True).group_by(
-                                                models.Post.id).filter(models.Post.id == id).first()   
-    return post
+    return cache_response(request, key, voted_post_dict(post), {cache.post_tag(id)}, generation)
 
 @router.post("/", status_code=status.HTTP_201_CREATED, response_model=schemas.PostResponse)
-def create_posts(post: schemas.PostCreate, db: Session = Depends(get_db), current_user: object = Depends(oauth2.get_current_user)):         
+def create_posts(post: schemas.PostCreate, db: Session = Depends(get_db), current_user: schemas.Principal = Depends(oauth2.get_current_principal)):         
     # Within fxn argument the post data is validated and cast as a pydantic model.  
     # With current_user as dependency, this fxn will run only if the user has been authenticated i.e. has a token
     
@@ -53,42 +236,47 @@ def create_posts(post: schemas.PostCreate, db: Session = Depends(get_db), curren
     new_post = models.Post(owner_id=current_user.id, **post.dict()) # known as **kwargs... **post.dict() is a more efficient way to represent line above. It unpacks the dictionary 
     db.add(new_post)
     db.commit() # surprisingly, at first posts were committed without commit and add fxns.... puzzling!
+    # a new post may belong on any page of the listing
+    cache.post_cache.invalidate([cache.LIST_TAG])
     db.refresh(new_post)
     return new_post
 
+@router.post("/bulk", status_code=status.HTTP_201_CREATED, response_model=List[schemas.PostResponse])
+def create_posts_bulk(posts: List[schemas.PostCreate], db: Session = Depends(get_db), current_user: schemas.Principal = Depends(oauth2.get_current_principal)):
+    # Creates many posts of the current user in one statement and one transaction.
+    # The created posts are returned in the order sent, rendered through the serialization fast path
+    check_bulk_size(posts)
+    if not posts:
+        return []
+
+    rows = db.execute(bulk_insert_statement(posts, current_user.id)).all()
+    db.commit()
+    cache.post_cache.invalidate([cache.LIST_TAG])
+    with timing.phase("serialization"):
+        return ORJSONResponse(content=[post_response_dict(row) for row in rows], status_code=status.HTTP_201_CREATED)
+
 @router .put("/{id}", response_model=schemas.PostResponse)
-def update_post(id: int, updated_post: schemas.PostCreate, db: Session = Depends(get_db), current_user: object = Depends(oauth2.get_current_user)):
+def update_post(id: int, updated_post: schemas.PostCreate, db: Session = Depends(get_db), current_user: schemas.Principal = Depends(oauth2.get_current_principal)):
 
-    post_query = db.query(models.Post).filter(models.Post.id == id)
-    post = post_query.first()
-    # if post to be updated does not exist, throw up 404 error
-    if post == None:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, 
-                            detail=f"post with id: {id} does not exist")
     # Ensure posts only get updated by the owner
-    if post.owner_id != current_user.id:
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, 
-                            detail=f"Not authorised to perform requested action")
-
-    post_query.update(updated_post.dict(), synchronize_session=False)
+    post = db.execute(update_statement(id, current_user.id, updated_post.dict())).one_or_none()
+    if post is None:
+        # if post to be updated does not exist, throw up 404 error. If it is someone else's, 403
+        raise write_missed(id, db.execute(owner_statement(id)).scalar())
     
     db.commit()
-    return post_query.first()
+    # a new title or content may also change which searches match the post
+    cache.post_cache.invalidate([cache.post_tag(id), cache.SEARCH_TAG])
+    return post_response_dict(post)
 
 @router.delete("/{id}", status_code=status.HTTP_204_NO_CONTENT)
-def delete_post(id: int, db: Session = Depends(get_db), current_user: object = Depends(oauth2.get_current_user)):
+def delete_post(id: int, db: Session = Depends(get_db), current_user: schemas.Principal = Depends(oauth2.get_current_principal)):
     
-    post_query = db.query(models.Post).filter(models.Post.id == id)
-    post = post_query.first()
-    
-    if post == None:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, 
-                            detail=f"post with id: {id} does not exist")
    # Ensure posts only get deleted by the owner
-    if post.owner_id != current_user.id:
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, 
-                            detail=f"Not authorised to perform requested action")
-    
-    post_query.delete(synchronize_session=False)
+    deleted = db.execute(delete_statement(id, current_user.id)).one_or_none()
+    if deleted is None:
+        raise write_missed(id, db.execute(owner_statement(id)).scalar())
     db.commit()
+    # later posts move up a place in every listing page
+    cache.post_cache.invalidate([cache.post_tag(id), cache.LIST_TAG])
     return Response(status_code=status.HTTP_204_NO_CONTENT)
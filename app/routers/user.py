@@ -1,12 +1,15 @@
-from fastapi import status, HTTPException, Depends, APIRouter
+from fastapi import status, HTTPException, Depends, APIRouter, Query
+from sqlalchemy import func, select, text
 from sqlalchemy.orm import Session
-from typing import List
-from .. import models, schemas, utils
-from ..database import get_db
+from typing import List, Optional
+from .. import models, schemas, oauth2, utils, timing, export, cache
+from ..config import settings
+from ..database import get_db, get_read_db
 
 router = APIRouter(
     prefix="/users",
-    tags=['Users']
+    tags=['Users'],
+    route_class=timing.TimedRoute
 )
 
 @router.post("/", status_code=status.HTTP_201_CREATED, response_model=schemas.UserOut)
@@ -24,13 +27,63 @@ def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
     return new_user
 
 @router.get("/", response_model=List[schemas.UserOut]) # e.g /posts, /users (Convention. Always plural.)
-def get_users(db: Session = Depends(get_db)):
-   
-    users = db.query(models.User).all()
+def get_users(db: Session = Depends(get_read_db), limit: int = Query(10, ge=1), after: Optional[int] = None):
+    # Users are returned a page at a time in id order. Limit is cut down to settings.users_page_max_size.
+    # After is the id of the last user of the previous page. Omit it to fetch the first page.
+    # The primary key index seeks straight to the cursor, so every page costs the same
+    users = db.query(models.User).filter(*users_after(after)).order_by(models.User.id).limit(page_size(limit)).all()
     return users
 
+# The number of users is read from the planner's estimate of the table size (pg_class.reltuples), kept up to date
+# by autovacuum and ANALYZE, instead of a COUNT(*) scanning the whole table. A table never analyzed has no estimate (-1)
+# and is counted. Either way the result is cached for settings.user_count_ttl_seconds
+count_cache = cache.TTLCache(1, settings.user_count_ttl_seconds)
+
+COUNT_ESTIMATE = text("SELECT reltuples::bigint FROM pg_class WHERE oid = CAST(:table AS regclass)") \
+                    .bindparams(table=models.User.__tablename__)
+COUNT = select(func.count()).select_from(models.User)
+
+def page_size(limit: int):
+    return min(limit, settings.users_page_max_size)
+
+def users_after(after: Optional[int]):
+    return [models.User.id > after] if after is not None else []
+
+@router.get("/count", response_model=schemas.UserCount)
+def count_users(db: Session = Depends(get_read_db)):
+    result = count_cache.get("users")
+    if result is None:
+        estimate = db.execute(COUNT_ESTIMATE).scalar()
+        if estimate >= 0:
+            result = {"count": estimate, "estimated": True}
+        else:
+            result = {"count": db.execute(COUNT).scalar(), "estimated": False}
+        count_cache.set("users", result)
+    return result
+
+# columns of schemas.UserOut. The password hash is never exported
+EXPORT_FIELDS = ["id", "email", "created_at"]
+
+def export_statement():
+    return select(models.User.id, models.User.email, models.User.created_at).order_by(models.User.id) \
+            .execution_options(stream_results=True)
+
+@router.get("/export")
+def export_users(db: Session = Depends(get_read_db), format: export.ExportFormat = export.ExportFormat.ndjson):
+    # Streams every user as NDJSON or CSV from a server-side cursor. Memory stays flat however many users there are
+    result = db.execute(export_statement())
+    return export.export_response(result.partitions(settings.export_batch_size), EXPORT_FIELDS, format, "users")
+
+@router.get("/me", response_model=schemas.UserOut)
+def get_me(current_user: models.User = Depends(oauth2.get_current_user)):
+    # The authenticated user's own row. It needs more than the token's claims, so it opts in to get_current_user,
+    # which serves repeated requests from oauth2.user_cache without a query
+    if current_user is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User does not exist")
+    return current_user
+
 @router.get("/{id}", response_model=schemas.UserOut)
-def get_user(id: int, db: Session = Depends(get_db)):
+def get_user(id: int, db: Session = Depends(get_read_db)):
     user = db.query(models.User).filter(models.User.id == id).first()
     if not user:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, 
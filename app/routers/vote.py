@@ -1,41 +1,152 @@
 from fastapi import status, HTTPException, Depends, APIRouter
+from sqlalchemy import Integer, delete, exc, literal, select, update
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm import Session
-from .. import database, models, schemas, oauth2
+from typing import List
+from .. import database, models, schemas, oauth2, cache, timing
+from ..config import settings
 
 router = APIRouter(
     prefix="/vote",
-    tags=["Vote"]
+    tags=["Vote"],
+    route_class=timing.TimedRoute
 )
 
+# A vote is added or removed in one statement, together with the denormalized vote_count of the post:
+#   WITH new_vote AS (INSERT INTO votes ... ON CONFLICT DO NOTHING RETURNING post_id)
+#   UPDATE posts SET vote_count = vote_count + 1 FROM new_vote WHERE posts.id = new_vote.post_id RETURNING posts.id
+# No row returned means the vote already existed (or, removing, did not exist). A missing post fails the foreign key of votes.
+# The session is not synchronized with the statement: the posts it may hold are not needed after a vote.
+# Concurrent duplicate votes are settled by the primary key of votes instead of racing between a SELECT and an INSERT
+def add_vote_statement(post_id: int, user_id: int):
+    new_vote = insert(models.Vote).values(post_id=post_id, user_id=user_id).on_conflict_do_nothing() \
+                .returning(models.Vote.post_id).cte("new_vote")
+    return update(models.Post).where(models.Post.id == new_vote.c.post_id) \
+                .values(vote_count=models.Post.vote_count + 1).returning(models.Post.id) \
+                .execution_options(synchronize_session=False)
+
+def remove_vote_statement(post_id: int, user_id: int):
+    old_vote = delete(models.Vote).where(models.Vote.post_id == post_id, models.Vote.user_id == user_id) \
+                .returning(models.Vote.post_id).cte("old_vote")
+    return update(models.Post).where(models.Post.id == old_vote.c.post_id) \
+                .values(vote_count=models.Post.vote_count - 1).returning(models.Post.id) \
+                .execution_options(synchronize_session=False)
+
+# Batches of votes, sent by clients replaying the votes they queued while offline.
+# A batch is applied with one INSERT and one DELETE statement, shaped like the statements above, in a single transaction.
+# The votes on a post are applied in the order sent, so only the last one decides whether the vote is left in place:
+# a queued vote then unvote leaves no vote, as two calls to POST /vote/ would.
+# The posts of a batch are locked first, in id order (lock_posts_statement). Without it two batches touching the same posts
+# in a different order each lock a row in one statement and wait on the other's in the next, and Postgres aborts one of them.
+# The locks also keep a post from being deleted between the SELECT and the INSERT of add_votes_statement
+def lock_posts_statement(post_ids: List[int]):
+    ''' Locks the existing posts among post_ids and returns their ids '''
+    return select(models.Post.id).where(models.Post.id.in_(post_ids)).order_by(models.Post.id).with_for_update()
+
+def add_votes_statement(post_ids: List[int], user_id: int):
+    # the votes are inserted from a SELECT of the posts: a missing post is skipped instead of failing the whole batch on the foreign key
+    posts = select(models.Post.id, literal(user_id, Integer)).where(models.Post.id.in_(post_ids))
+    new_votes = insert(models.Vote).from_select(["post_id", "user_id"], posts).on_conflict_do_nothing() \
+                .returning(models.Vote.post_id).cte("new_votes")
+    return update(models.Post).where(models.Post.id == new_votes.c.post_id) \
+                .values(vote_count=models.Post.vote_count + 1).returning(models.Post.id) \
+                .execution_options(synchronize_session=False)
+
+def remove_votes_statement(post_ids: List[int], user_id: int):
+    old_votes = delete(models.Vote).where(models.Vote.post_id.in_(post_ids), models.Vote.user_id == user_id) \
+                .returning(models.Vote.post_id).cte("old_votes")
+    return update(models.Post).where(models.Post.id == old_votes.c.post_id) \
+                .values(vote_count=models.Post.vote_count - 1).returning(models.Post.id) \
+                .execution_options(synchronize_session=False)
+
+def check_batch_size(votes: List[schemas.Vote]):
+    if len(votes) > settings.vote_batch_max_size:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                            detail=f"A batch holds at most {settings.vote_batch_max_size} votes")
+
+def split_batch(votes: List[schemas.Vote]):
+    ''' Returns the ids of the posts to vote on and of the posts to take the vote off, by the last vote of the batch on each post '''
+    last_dir = {vote.post_id: vote.dir for vote in votes}
+    add_ids = [post_id for post_id, dir in last_dir.items() if dir == 1]
+    remove_ids = [post_id for post_id, dir in last_dir.items() if dir != 1]
+    return add_ids, remove_ids
+
+def batch_results(votes: List[schemas.Vote], user_id: int, added, removed, existing):
+    '''
+    Result of each vote of a batch, in the order sent: what POST /vote/ would have answered had the votes been sent one by one.
+    existing holds the posts of the batch that exist, added and removed those whose vote the batch created or deleted
+    '''
+    # the state before the batch is worked out from what the statements changed:
+    # a vote was there if the batch deleted it, or if the batch left it in place on an existing post
+    last_dir = {vote.post_id: vote.dir for vote in votes}
+    voted = removed | {post_id for post_id in existing - added - removed if last_dir[post_id] == 1}
+
+    results = []
+    for vote in votes:
+        if vote.dir == 1 and vote.post_id not in existing:
+            status_code, detail = status.HTTP_404_NOT_FOUND, f"Post with id: {vote.post_id} does not exist"
+        elif vote.dir == 1 and vote.post_id in voted:
+            status_code, detail = status.HTTP_409_CONFLICT, f"user {user_id} has already voted on post {vote.post_id}"
+        elif vote.dir == 1:
+            status_code, detail = status.HTTP_201_CREATED, "successfully added vote"
+            voted.add(vote.post_id)
+        elif vote.post_id in voted:
+            status_code, detail = status.HTTP_201_CREATED, "successfully deleted vote"
+            voted.discard(vote.post_id)
+        else:
+            status_code, detail = status.HTTP_404_NOT_FOUND, "Vote does not exist"
+        results.append({"post_id": vote.post_id, "dir": vote.dir, "status_code": status_code, "detail": detail})
+    return results
+
+def post_not_found(post_id: int):
+    return HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Post with id: {post_id} does not exist")
+
 @router.post("/", status_code=status.HTTP_201_CREATED)
-def vote(vote: schemas.Vote, db: Session = Depends(database.get_db), current_user: object = Depends(oauth2.get_current_user)):
-    
-    post = db.query(models.Post).filter(models.Post.id == vote.post_id).first()
-    if not post:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Post with id: {vote.post_id} does not exist")
-    
+def vote(vote: schemas.Vote, db: Session = Depends(database.get_db), current_user: schemas.Principal = Depends(oauth2.get_current_principal)):
+
     '''
     # implementing logic to prevent users from voting on their own posts
     if post.owner_id == current_user.id:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=f"user {current_user.id} cannot vote on their own post")
     '''
-    
-    vote_query = db.query(models.Vote).filter(models.Vote.post_id == vote.post_id, models.Vote.user_id == current_user.id)
-    found_vote = vote_query.first()
+
     if (vote.dir == 1):
-        if found_vote:
+        try:
+            voted = db.execute(add_vote_statement(vote.post_id, current_user.id)).first()
+            db.commit()
+        except exc.IntegrityError as error:
+            db.rollback()
+            if database.pgcode(error) == database.FOREIGN_KEY_VIOLATION:
+                raise post_not_found(vote.post_id)
+            raise
+        if not voted:
             raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"user {current_user.id} has already voted on post {vote.post_id}")
-    
-        new_vote = models.Vote(post_id = vote.post_id, user_id=current_user.id)
-        db.add(new_vote)
-        db.commit()
+        # cached responses holding the post show its old vote count
+        cache.post_cache.invalidate([cache.post_tag(vote.post_id)])
         return {"message": "successfully added vote"}
 
     else:
-        if not found_vote:
+        removed = db.execute(remove_vote_statement(vote.post_id, current_user.id)).first()
+        db.commit()
+        if not removed:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Vote does not exist")
+        cache.post_cache.invalidate([cache.post_tag(vote.post_id)])
 
-        vote_query.delete(synchronize_session=False)
-        db.commit()
+        return {"message": "successfully deleted vote"}
+
+@router.post("/batch", response_model=List[schemas.VoteResult])
+def vote_batch(votes: List[schemas.Vote], db: Session = Depends(database.get_db), current_user: schemas.Principal = Depends(oauth2.get_current_principal)):
+    # Applies a list of votes with one authentication, one transaction and one commit.
+    # Every vote gets a result, in the order sent, instead of the whole batch failing on one bad vote
+    check_batch_size(votes)
+    if not votes:
+        return []
+    add_ids, remove_ids = split_batch(votes)
+
+    existing = set(db.execute(lock_posts_statement(add_ids + remove_ids)).scalars())
+    added = set(db.execute(add_votes_statement(add_ids, current_user.id)).scalars()) if add_ids else set()
+    removed = set(db.execute(remove_votes_statement(remove_ids, current_user.id)).scalars()) if remove_ids else set()
+    db.commit()
 
-        return {"message": "successfully deleted vote"}
\ No newline at end of file
+    cache.post_cache.invalidate([cache.post_tag(post_id) for post_id in added | removed])
+    return batch_results(votes, current_user.id, added, removed, existing)
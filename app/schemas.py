@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import List, Optional
 from pydantic import BaseModel, conint
 from datetime import datetime
 from pydantic import EmailStr
@@ -51,7 +51,15 @@ class PostVoted(BaseModel):
     Post: PostResponse
     votes: int
 
-    
+class PostPage(BaseModel):
+    """
+    This class validates the schema of a page of voted posts returned in cursor pagination mode.
+    next_cursor is passed back as the 'after' query parameter to fetch the following page. It is None on the last page.
+    """
+    items: List[PostVoted]
+    next_cursor: Optional[str] = None
+
+
 
 
 class UserCreate(BaseModel):
@@ -59,6 +67,11 @@ class UserCreate(BaseModel):
     password: str
 
 
+class UserCount(BaseModel):
+    ''' Number of users. estimated is true when it comes from the planner statistics rather than a COUNT '''
+    count: int
+    estimated: bool
+
 class UserLogin(BaseModel):
     email: EmailStr
     password: str
@@ -70,6 +83,20 @@ class Token(BaseModel):
 class TokenData(BaseModel):
     id: Optional[str] = None
 
+class Principal(BaseModel):
+    ''' The authenticated user as known from the access token alone, without loading the user's row '''
+    id: int
+
 class Vote(BaseModel):
     post_id: int
     dir: conint(ge=0, le=1) # This ensures that the integer recieved in the body of the token is either 0 or 1
+
+class VoteResult(BaseModel):
+    '''
+    Outcome of one vote of a batch sent to /vote/batch.
+    status_code and detail are what POST /vote/ would have answered had the votes of the batch been sent one by one
+    '''
+    post_id: int
+    dir: int
+    status_code: int
+    detail: str
@@ -0,0 +1,180 @@
+import asyncio
+import functools
+import json
+import logging
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from fastapi.routing import APIRoute
+from sqlalchemy import event
+from starlette.datastructures import MutableHeaders
+from . import metrics
+from .config import settings
+
+# Per-request timing of the hot path.
+# TimingMiddleware starts a RequestTimings for every request. The phases are added up as the request runs:
+#   auth           get_current_principal (or get_current_user): verifying the token and looking up the user
+#   db             every SQL statement, timed by cursor execute events of the engines
+#   handler        the path operation function itself
+#   serialization  validating and rendering the response
+# Phases overlap (db time is also part of auth and handler). They are sent back in a Server-Timing header
+# and logged as one json line per request, with the number of SQL statements run.
+
+logger = logging.getLogger(__name__)
+if not logger.handlers:
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(levelname)s:     %(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+
+class RequestTimings:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = defaultdict(float) # phase -> seconds
+        self.statements = Counter() # sql -> times executed. The same sql run many times in one request is usually an N+1 pattern
+        self.route = None # path template of the matched route e.g. /posts/{id}
+        self.endpoint_done = None
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def server_timing(self):
+        entries = [f"{name};dur={seconds * 1000:.2f}" for name, seconds in self.phases.items()]
+        entries.append(f'db_statements;desc="{sum(self.statements.values())} statements"')
+        entries.append(f"total;dur={self.elapsed() * 1000:.2f}")
+        return ", ".join(entries)
+
+    def repeated_statements(self):
+        threshold = settings.timing_repeated_statement_threshold
+        return {statement: count for statement, count in self.statements.items() if count >= threshold}
+
+
+# The RequestTimings of the request being served.
+# Sync path operations and dependencies run in the threadpool with a copy of this context, so they add to the same object
+request_timings: ContextVar[RequestTimings] = ContextVar("request_timings", default=None)
+
+
+@contextmanager
+def phase(name: str):
+    ''' Adds the time spent in the block to a phase of the current request '''
+    timings = request_timings.get()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.phases[name] += time.perf_counter() - start
+
+
+def instrument_engine(engine):
+    ''' Times and counts the SQL statements an engine executes for the current request '''
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["query_start_time"].pop()
+        timings = request_timings.get()
+        if timings is not None:
+            timings.phases["db"] += time.perf_counter() - started
+            timings.statements[statement] += 1
+
+
+def timed_endpoint(endpoint):
+    ''' Wraps a path operation function so its run counts as the handler phase. Keeps it sync or async '''
+    def done(timings):
+        if timings is not None:
+            timings.endpoint_done = time.perf_counter()
+
+    if asyncio.iscoroutinefunction(endpoint):
+        @functools.wraps(endpoint)
+        async def timed(*args, **kwargs):
+            with phase("handler"):
+                response = await endpoint(*args, **kwargs)
+            done(request_timings.get())
+            return response
+    else:
+        @functools.wraps(endpoint)
+        def timed(*args, **kwargs):
+            with phase("handler"):
+                response = endpoint(*args, **kwargs)
+            done(request_timings.get())
+            return response
+    return timed
+
+
+class TimedRoute(APIRoute):
+    '''
+    Route class of every router. Records the route's path template on the request's timings
+    and times the handler and serialization phases
+    '''
+    def get_route_handler(self):
+        if not getattr(self.dependant.call, "timed", False):
+            self.dependant.call = timed_endpoint(self.dependant.call)
+            self.dependant.call.timed = True
+        route_handler = super().get_route_handler()
+        path = self.path_format
+
+        async def timed_route_handler(request):
+            timings = request_timings.get()
+            if timings is None:
+                return await route_handler(request)
+            timings.route = path
+            response = await route_handler(request)
+            # whatever FastAPI does after the endpoint returns is response validation and rendering
+            if timings.endpoint_done is not None:
+                timings.phases["serialization"] += time.perf_counter() - timings.endpoint_done
+            return response
+
+        return timed_route_handler
+
+
+class TimingMiddleware:
+    ''' ASGI middleware adding the Server-Timing header and the timing log line to every http request '''
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        timings = RequestTimings()
+        token = request_timings.set(timings)
+        status_code = 500
+
+        async def send_with_server_timing(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                MutableHeaders(scope=message).append("Server-Timing", timings.server_timing())
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_server_timing)
+        finally:
+            request_timings.reset(token)
+            log_request(scope, status_code, timings)
+            metrics.observe_request(scope["method"], timings.route, status_code, timings.elapsed(),
+                                    timings.phases.get("db", 0.0), sum(timings.statements.values()))
+
+
+def log_request(scope, status_code: int, timings: RequestTimings):
+    record = {
+        "method": scope["method"],
+        "path": scope["path"],
+        "route": timings.route,
+        "status": status_code,
+        "total_ms": round(timings.elapsed() * 1000, 2),
+        **{f"{name}_ms": round(seconds * 1000, 2) for name, seconds in timings.phases.items()},
+        "statements": sum(timings.statements.values()),
+    }
+    logger.info(json.dumps(record))
+    repeated = timings.repeated_statements()
+    if repeated:
+        logger.warning(json.dumps({"method": scope["method"], "route": timings.route, "possible_n_plus_one": repeated}))
@@ -1,12 +1,66 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import HTTPException, status
 from passlib.context import CryptContext
+from .config import settings
 
 # abstracting the logic for password hashing.
 # users' passwords are hashed prior to storage in database
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+class BoundedExecutor:
+    '''
+    A thread pool which admits at most max_workers + max_queue calls at a time.
+    Calls beyond that are rejected with a 503 straight away instead of waiting in line.
+    '''
+    def __init__(self, max_workers: int, max_queue: int, thread_name_prefix: str = ""):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.in_flight = 0 # calls running or waiting for a worker
+        self.rejected = 0
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+        self._slots = threading.BoundedSemaphore(max_workers + max_queue)
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, 
+                                detail="Server is busy. Try again shortly", headers={"Retry-After": "1"})
+        with self._lock:
+            self.in_flight += 1
+        return self._executor.submit(self._call, fn, *args)
+
+    def _call(self, fn, *args):
+        try:
+            return fn(*args)
+        finally:
+            # free the slot before the result is handed back to the caller
+            with self._lock:
+                self.in_flight -= 1
+            self._slots.release()
+
+    def run(self, fn, *args):
+        ''' Runs fn on the pool and waits for its result '''
+        return self.submit(fn, *args).result()
+
+# bcrypt is deliberately slow (100-300 ms a call). It runs on its own small pool so that a burst of logins 
+# holds at most bcrypt_max_workers + bcrypt_max_queue request threads. Every other path operation keeps the rest of the threadpool
+bcrypt_executor = BoundedExecutor(max_workers=settings.bcrypt_max_workers, max_queue=settings.bcrypt_max_queue, 
+                                    thread_name_prefix="bcrypt")
+
 def hash(password: str):
-    return pwd_context.hash(password)
+    return bcrypt_executor.run(pwd_context.hash, password)
 
 def verify(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+    return bcrypt_executor.run(pwd_context.verify, plain_password, hashed_password)
+
+# awaitable versions for async path operations. The event loop carries on while bcrypt runs
+async def hash_async(password: str):
+    return await asyncio.wrap_future(bcrypt_executor.submit(pwd_context.hash, password))
+
+async def verify_async(plain_password, hashed_password):
+    return await asyncio.wrap_future(bcrypt_executor.submit(pwd_context.verify, plain_password, hashed_password))
@@ -0,0 +1,47 @@
+"""
+Benchmark of access token verification.
+
+Compares decoding a bearer token with python-jose (the default backend), with PyJWT
+(JWT_BACKEND=pyjwt, when installed) and verifying it through oauth2.verify_access_token,
+which answers repeated tokens from oauth2.token_cache. No database is needed.
+
+Usage:
+    python -m tests.benchmarks.bench_jwt --repeat 20000
+"""
+import argparse
+import timeit
+
+from fastapi import HTTPException
+
+from app import oauth2
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=20000, help="verifications per path")
+    args = parser.parse_args()
+
+    token = oauth2.create_access_token({"user_id": 1})
+    credentials_exception = HTTPException(status_code=401)
+
+    paths = [("python-jose", lambda: oauth2.jose_decode(token))]
+    if oauth2.pyjwt is not None:
+        paths.append(("pyjwt", lambda: oauth2.pyjwt_decode(token)))
+    else:
+        print("PyJWT is not installed, skipping it (pip install PyJWT)")
+    paths.append(("token cache", lambda: oauth2.verify_access_token(token, credentials_exception)))
+
+    results = {}
+    for name, verify in paths:
+        seconds = min(timeit.repeat(verify, number=args.repeat, repeat=3))
+        results[name] = seconds / args.repeat * 1e6
+        print(f"{name:<12} {results[name]:10.2f} us per token")
+
+    baseline = results["python-jose"]
+    for name, microseconds in results.items():
+        if name != "python-jose":
+            print(f"{name + ' speedup':<20} {baseline / microseconds:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
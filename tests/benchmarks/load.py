@@ -0,0 +1,204 @@
+"""
+Load benchmark of the API.
+
+Runs each scenario against a running server for a fixed time with a pool of concurrent
+clients, then reports requests per second and p50/p95/p99 latency. Results are saved as json
+under tests/benchmarks/results, named by time and commit, so runs can be compared across commits.
+
+Scenarios:
+    list     GET /posts/ at random offsets
+    page     GET /posts/page following next_cursor from the first page
+    detail   GET /posts/{id} of random posts
+    vote     POST /vote/ adding and removing votes of random users on random posts
+    batch    POST /vote/batch with 20 such votes per request
+    login    POST /login as random users (bcrypt bound)
+
+Usage:
+    python -m tests.benchmarks.seed
+    DATABASE_NAME=<database_name>_bench uvicorn app.main:app --workers 4
+    python -m tests.benchmarks.load --concurrency 32 --duration 30
+    python -m tests.benchmarks.load --scenario list --compare tests/benchmarks/results/<earlier run>.json
+"""
+import argparse
+import json
+import random
+import subprocess
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from pathlib import Path
+
+import requests
+
+from app.oauth2 import create_access_token
+from tests.benchmarks.seed import PASSWORD, user_email
+
+RESULTS_DIR = Path(__file__).parent / "results"
+
+
+class Context:
+    ''' What the scenarios need to know about the seeded data set '''
+    def __init__(self, base_url: str, users: int, posts: int):
+        self.base_url = base_url
+        self.users = users
+        self.posts = posts
+        # tokens are signed here rather than requested from /login, so only the login scenario pays for bcrypt
+        self.tokens = {user_id: create_access_token({"user_id": user_id}) for user_id in range(1, min(users, 200) + 1)}
+
+    def auth(self, rng: random.Random, user_id: int = None):
+        user_id = user_id or rng.choice(list(self.tokens))
+        return {"Authorization": f"Bearer {self.tokens[user_id]}"}
+
+
+def list_posts(client, ctx, rng, state):
+    return client.get(f"{ctx.base_url}/posts/", params={"limit": 10, "skip": rng.randrange(ctx.posts)}, headers=ctx.auth(rng))
+
+def page_posts(client, ctx, rng, state):
+    params = {"limit": 10}
+    if state.get("cursor"):
+        params["after"] = state["cursor"]
+    res = client.get(f"{ctx.base_url}/posts/page", params=params, headers=ctx.auth(rng))
+    if res.status_code == 200:
+        state["cursor"] = res.json()["next_cursor"] # back to the first page after the last one
+    return res
+
+def post_detail(client, ctx, rng, state):
+    return client.get(f"{ctx.base_url}/posts/{rng.randint(1, ctx.posts)}", headers=ctx.auth(rng))
+
+def vote_churn(client, ctx, rng, state):
+    # 409 (already voted) and 404 (no vote to remove) are expected answers, not errors
+    user_id = rng.choice(list(ctx.tokens))
+    vote = {"post_id": rng.randint(1, ctx.posts), "dir": rng.randint(0, 1)}
+    return client.post(f"{ctx.base_url}/vote/", json=vote, headers=ctx.auth(rng, user_id))
+
+def vote_batch(client, ctx, rng, state):
+    user_id = rng.choice(list(ctx.tokens))
+    votes = [{"post_id": rng.randint(1, ctx.posts), "dir": rng.randint(0, 1)} for _ in range(20)]
+    return client.post(f"{ctx.base_url}/vote/batch", json=votes, headers=ctx.auth(rng, user_id))
+
+def login_storm(client, ctx, rng, state):
+    credentials = {"username": user_email(rng.randint(1, ctx.users)), "password": PASSWORD}
+    return client.post(f"{ctx.base_url}/login", data=credentials)
+
+SCENARIOS = {
+    "list": list_posts,
+    "page": page_posts,
+    "detail": post_detail,
+    "vote": vote_churn,
+    "batch": vote_batch,
+    "login": login_storm,
+}
+
+
+def percentile(sorted_values, percent: float):
+    ''' Nearest-rank percentile of an already sorted list '''
+    if not sorted_values:
+        return 0.0
+    rank = max(int(round(percent / 100 * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def run_scenario(scenario, ctx: Context, concurrency: int, duration: float, seed: int):
+    latencies = []
+    statuses = Counter()
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def client_loop(number: int):
+        rng = random.Random(seed * 1000 + number)
+        client = requests.Session()
+        state = {}
+        own_latencies, own_statuses = [], Counter()
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                status_code = scenario(client, ctx, rng, state).status_code
+            except requests.RequestException:
+                status_code = "connection error"
+            own_latencies.append(time.perf_counter() - start)
+            own_statuses[status_code] += 1
+        with lock:
+            latencies.extend(own_latencies)
+            statuses.update(own_statuses)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client_loop, args=(number,)) for number in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    errors = sum(count for status_code, count in statuses.items() if status_code == "connection error" or status_code >= 500)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "max_ms": (latencies[-1] if latencies else 0.0) * 1000,
+        "statuses": {str(status_code): count for status_code, count in sorted(statuses.items(), key=str)},
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def print_report(report, baseline=None):
+    print(f"{'scenario':<8} {'rps':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>7}")
+    for name, result in report["scenarios"].items():
+        print(f"{name:<8} {result['rps']:9.1f} {result['p50_ms']:9.2f} {result['p95_ms']:9.2f} {result['p99_ms']:9.2f} {result['errors']:7d}")
+        previous = (baseline or {}).get("scenarios", {}).get(name)
+        if previous:
+            change = lambda key: (result[key] - previous[key]) / previous[key] * 100 if previous[key] else 0.0
+            print(f"{'  vs ' + baseline['commit']:<8} {change('rps'):+8.1f}% {change('p50_ms'):+8.1f}% "
+                    f"{change('p95_ms'):+8.1f}% {change('p99_ms'):+8.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--scenario", action="append", choices=list(SCENARIOS), help="repeat to run several. Default: all")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=20, help="seconds per scenario")
+    parser.add_argument("--users", type=int, default=1000, help="users in the seeded data set")
+    parser.add_argument("--posts", type=int, default=20000, help="posts in the seeded data set")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--compare", type=Path, help="earlier results file to compare against")
+    parser.add_argument("--no-save", action="store_true")
+    args = parser.parse_args()
+
+    ctx = Context(args.base_url, args.users, args.posts)
+    report = {
+        "commit": git_commit(),
+        "started_at": datetime.now().isoformat(timespec="seconds"),
+        "base_url": args.base_url,
+        "concurrency": args.concurrency,
+        "duration": args.duration,
+        "users": args.users,
+        "posts": args.posts,
+        "scenarios": {},
+    }
+    for name in args.scenario or SCENARIOS:
+        print(f"running {name} for {args.duration:g}s with {args.concurrency} clients")
+        report["scenarios"][name] = run_scenario(SCENARIOS[name], ctx, args.concurrency, args.duration, args.seed)
+
+    baseline = json.loads(args.compare.read_text()) if args.compare else None
+    print_report(report, baseline)
+
+    if not args.no_save:
+        RESULTS_DIR.mkdir(exist_ok=True)
+        path = RESULTS_DIR / f"{datetime.now():%Y%m%d-%H%M%S}-{report['commit']}.json"
+        path.write_text(json.dumps(report, indent=2))
+        print(f"saved {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Seeded data generator for the load benchmarks.
+
+Fills a dedicated benchmark database, {DATABASE_NAME}_bench, with users, posts and votes
+built through app.models. The same --seed always produces the same data set, so runs on
+different commits measure the same workload. Votes favour a minority of popular posts and
+vote_count is filled in to match, as the vote router would have kept it.
+
+Every existing table of the benchmark database is dropped first.
+
+Usage:
+    python -m tests.benchmarks.seed --users 1000 --posts 20000 --votes 100000
+"""
+import argparse
+import random
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import create_engine, text
+
+from app import models, utils
+from app.config import settings
+from app.database import Base
+
+BENCH_DATABASE_URL = f'postgresql://{settings.database_username}:{settings.database_password}@{settings.database_hostname}:{settings.database_port}/{settings.database_name}_bench'
+
+# every seeded user shares this password so login storms can sign in as anyone
+PASSWORD = "password123"
+
+CHUNK_SIZE = 5000
+
+
+def user_email(number: int):
+    return f"user{number}@bench.example.com"
+
+
+def generate(users: int, posts: int, votes: int, seed: int = 42):
+    ''' Returns the rows of the users, posts and votes tables. Ids start at 1 '''
+    rng = random.Random(seed)
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    # bcrypt takes ~100 ms a call, so every user gets the same hash
+    hashed_password = utils.pwd_context.hash(PASSWORD)
+
+    user_rows = [{"id": number, "email": user_email(number), "password": hashed_password,
+                    "created_at": now - timedelta(days=365, minutes=number)} for number in range(1, users + 1)]
+
+    # a few posts collect most of the votes
+    votes = min(votes, users * posts)
+    vote_pairs = set()
+    while len(vote_pairs) < votes:
+        post_id = int(posts * rng.random() ** 3) + 1
+        vote_pairs.add((rng.randint(1, users), post_id))
+    vote_counts = Counter(post_id for _, post_id in vote_pairs)
+
+    post_rows = [{"id": number, "title": f"post {number} about {rng.choice(WORDS)} and {rng.choice(WORDS)}",
+                    "content": " ".join(rng.choices(WORDS, k=rng.randint(20, 120))), "published": True,
+                    "created_at": now - timedelta(seconds=rng.randint(0, 365 * 24 * 3600)),
+                    "owner_id": rng.randint(1, users), "vote_count": vote_counts[number]} for number in range(1, posts + 1)]
+
+    vote_rows = [{"user_id": user_id, "post_id": post_id} for user_id, post_id in sorted(vote_pairs)]
+    return user_rows, post_rows, vote_rows
+
+
+def insert_rows(connection, table, rows):
+    for start in range(0, len(rows), CHUNK_SIZE):
+        connection.execute(table.insert(), rows[start:start + CHUNK_SIZE])
+
+
+def seed(engine, users: int, posts: int, votes: int, seed: int = 42):
+    user_rows, post_rows, vote_rows = generate(users, posts, votes, seed)
+
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as connection:
+        insert_rows(connection, models.User.__table__, user_rows)
+        insert_rows(connection, models.Post.__table__, post_rows)
+        insert_rows(connection, models.Vote.__table__, vote_rows)
+        # ids were given explicitly so move the sequences past them
+        connection.execute(text("SELECT setval('users_id_seq', (SELECT MAX(id) FROM users))"))
+        connection.execute(text("SELECT setval('posts_id_seq', (SELECT MAX(id) FROM posts))"))
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        # fresh planner statistics, as a long running database would have
+        connection.execute(text("VACUUM ANALYZE"))
+    return len(user_rows), len(post_rows), len(vote_rows)
+
+
+WORDS = ("python fastapi postgres index query cache vote post user token latency throughput pool "
+         "replica cursor page search json async thread worker deploy heroku docker alembic "
+         "migration schema pydantic orm session commit rollback benchmark profile").split()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--posts", type=int, default=20000)
+    parser.add_argument("--votes", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    users, posts, votes = seed(create_engine(BENCH_DATABASE_URL), args.users, args.posts, args.votes, args.seed)
+    print(f"seeded {users} users, {posts} posts and {votes} votes in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,16 @@
 from fastapi.testclient import TestClient
 import pytest
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
-from app import models
+from sqlalchemy.pool import NullPool
+from app import deadline, models, timing
 from app.main import app
 from app.config import settings
-from app.database import get_db, Base
-from app.oauth2 import create_access_token
+from app.database import get_db, get_async_db, get_read_db, get_async_read_db, Base
+from app.cache import post_cache
+from app.oauth2 import create_access_token, token_cache, user_cache
+from app.routers.user import count_cache
 
 # Create a dummy database for testing purposes
 SQL_ALCHEMY_DATABASE_URL = f'postgresql://{settings.database_username}:{settings.database_password}@{settings.database_hostname}:{settings.database_port}/{settings.database_name}_test'
@@ -15,6 +19,40 @@ SQL_ALCHEMY_DATABASE_URL = f'postgresql://{settings.database_username}:{settings
 engine = create_engine(SQL_ALCHEMY_DATABASE_URL)
 
 TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# statements run against the test database are timed and counted in the Server-Timing header too,
+# and cancelled when the client disconnects
+timing.instrument_engine(engine)
+deadline.instrument_engine(engine)
+
+# With DATABASE_ASYNC=true the same tests run against the async routers.
+# TestClient runs every request in a new event loop so async connections are not pooled between requests
+async_engine = create_async_engine(SQL_ALCHEMY_DATABASE_URL.replace('postgresql://', 'postgresql+asyncpg://', 1), 
+                                    poolclass=NullPool) if settings.database_async else None
+
+TestingAsyncSessionLocal = sessionmaker(bind=async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+if async_engine is not None:
+    timing.instrument_engine(async_engine.sync_engine)
+    deadline.instrument_engine(async_engine.sync_engine)
+
+
+@pytest.fixture
+def statement_counter():
+    '''
+    Records the SQL statements run against the test database while it is in use
+
+    Returns:
+    statements: list. Each executed statement, appended as it runs
+    '''
+    statements = []
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    engines = [engine] if async_engine is None else [engine, async_engine.sync_engine]
+    for test_engine in engines:
+        event.listen(test_engine, "before_cursor_execute", count_statement)
+    yield statements
+    for test_engine in engines:
+        event.remove(test_engine, "before_cursor_execute", count_statement)
 
 
 @pytest.fixture(scope="function")
@@ -52,8 +90,21 @@ def client(session): # A pytest fixture can pass in another pytest fixture funct
         finally:
             session.close()
 
+    async def override_get_async_db():
+        async with TestingAsyncSessionLocal() as db:
+            yield db
+
     # swaps get_db fxn with override_get_db throughout app 
     app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_async_db] = override_get_async_db
+    # reads go to the same test database as writes
+    app.dependency_overrides[get_read_db] = override_get_db
+    app.dependency_overrides[get_async_read_db] = override_get_async_db
+    # ids are reused once tables are recreated so rows cached by a previous test must go
+    user_cache.clear()
+    token_cache.clear()
+    post_cache.clear()
+    count_cache.clear()
     yield TestClient(app)                        
                             
     # ---- the db manipulation can also be done with alembic ----
@@ -0,0 +1,84 @@
+import time
+from app.cache import TTLCache, InMemoryResponseCache
+
+
+def test_cache_hit_and_miss():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set(1, "kelvin")
+
+    assert cache.get(1) == "kelvin"
+    assert cache.get(2) is None
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+    assert cache.stats()["hit_ratio"] == 0.5
+
+def test_cache_evicts_least_recently_used():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set(1, "first")
+    cache.set(2, "second")
+    cache.get(1) # 2 is now the least recently used entry
+    cache.set(3, "third")
+
+    assert cache.get(2) is None
+    assert cache.get(1) == "first"
+    assert cache.get(3) == "third"
+    assert len(cache) == 2
+
+def test_cache_entry_expires():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set(1, "short lived", ttl=0.01)
+    time.sleep(0.02)
+
+    assert cache.get(1) is None
+    assert len(cache) == 0
+
+def test_cache_pop():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set(1, "kelvin")
+
+    assert cache.pop(1) == "kelvin"
+    assert cache.get(1) is None
+
+def test_response_cache_invalidates_by_tag():
+    cache = InMemoryResponseCache(maxsize=10, ttl=60)
+    cache.set("page 1", b"[1, 2]", tags={"posts", "post:1", "post:2"})
+    cache.set("post 1", b"1", tags={"post:1"})
+    cache.set("post 3", b"3", tags={"post:3"})
+
+    cache.invalidate(["post:1"])
+
+    assert cache.get("page 1") is None
+    assert cache.get("post 1") is None
+    assert cache.get("post 3") == b"3"
+    assert cache.stats()["invalidations"] == 2
+
+def test_response_cache_evicts_least_recently_used():
+    cache = InMemoryResponseCache(maxsize=1, ttl=60)
+    cache.set("post 1", b"1", tags={"post:1"})
+    cache.set("post 2", b"2", tags={"post:2"})
+
+    assert cache.get("post 1") is None
+    assert cache.get("post 2") == b"2"
+    assert cache.stats()["hit_ratio"] == 0.5
+
+def test_response_cache_drops_fill_older_than_invalidation():
+    cache = InMemoryResponseCache(maxsize=10, ttl=60)
+    generation = cache.generation() # a reader misses and goes to the database
+    cache.invalidate(["post:1"]) # a writer commits and invalidates meanwhile
+
+    cache.set("post 1", b"old 1", tags={"post:1"}, generation=generation)
+    cache.set("post 2", b"2", tags={"post:2"}, generation=generation)
+
+    assert cache.get("post 1") is None
+    assert cache.get("post 2") == b"2"
+
+def test_response_cache_drops_fill_older_than_forgotten_invalidations():
+    cache = InMemoryResponseCache(maxsize=2, ttl=60)
+    generation = cache.generation()
+    cache.invalidate(["post:1", "post:2", "post:3"]) # more tags than kept
+
+    cache.set("post 4", b"4", tags={"post:4"}, generation=generation)
+    cache.set("post 5", b"5", tags={"post:5"}, generation=cache.generation())
+
+    assert cache.get("post 4") is None
+    assert cache.get("post 5") == b"5"
@@ -0,0 +1,32 @@
+import time
+from starlette.requests import Request
+from app import database
+
+
+def make_request(cookies: dict = {}):
+    cookie_header = "; ".join(f"{name}={value}" for name, value in cookies.items())
+    return Request({"type": "http", "headers": [(b"cookie", cookie_header.encode())]})
+
+def test_reads_use_primary_without_replicas():
+    assert database.pick_read_sessionmaker(make_request(), "primary", []) == "primary"
+
+def test_reads_alternate_between_replicas():
+    replicas = ["replica_0", "replica_1"]
+    picked = {database.pick_read_sessionmaker(make_request(), "primary", replicas) for _ in range(4)}
+
+    assert picked == set(replicas)
+
+def test_reads_stick_to_primary_after_write():
+    replicas = ["replica_0", "replica_1"]
+    just_wrote = make_request({database.PRIMARY_UNTIL_COOKIE: time.time() + 5})
+    wrote_long_ago = make_request({database.PRIMARY_UNTIL_COOKIE: time.time() - 5})
+
+    assert database.pick_read_sessionmaker(just_wrote, "primary", replicas) == "primary"
+    assert database.pick_read_sessionmaker(wrote_long_ago, "primary", replicas) in replicas
+
+def test_reads_from_replica(monkeypatch):
+    assert not database.reads_from_replica(make_request())
+    monkeypatch.setattr(database, "replica_engines", ["replica_0"])
+
+    assert database.reads_from_replica(make_request())
+    assert not database.reads_from_replica(make_request({database.PRIMARY_UNTIL_COOKIE: time.time() + 5}))
@@ -0,0 +1,149 @@
+import asyncio
+import time
+import pytest
+from sqlalchemy import create_engine, exc, text
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
+from app import database, deadline, metrics
+from app.config import settings
+from app.main import app
+from app.routers import post
+from app.routers.aio import post as aio_post
+from tests.conftest import SQL_ALCHEMY_DATABASE_URL
+
+SLEEP = text("(SELECT 1 FROM pg_sleep(2)) = 1")
+
+
+def test_statement_timeout_cancels_query():
+    engine = create_engine(SQL_ALCHEMY_DATABASE_URL, connect_args=database.connect_args(0.1), poolclass=NullPool)
+    with pytest.raises(exc.OperationalError) as error:
+        with engine.connect() as conn:
+            conn.execute(text("SELECT pg_sleep(2)"))
+    assert database.pgcode(error.value) == database.QUERY_CANCELED
+
+def test_statement_timeout_returns_503(authorised_client, test_posts, monkeypatch):
+    # the listing runs on sessions whose statements time out after 100ms and is made to sleep for longer
+    sync_engine = create_engine(SQL_ALCHEMY_DATABASE_URL, connect_args=database.connect_args(0.1), poolclass=NullPool)
+    async_engine = create_async_engine(SQL_ALCHEMY_DATABASE_URL.replace('postgresql://', 'postgresql+asyncpg://', 1),
+                                        connect_args=database.async_connect_args(0.1), poolclass=NullPool)
+    def get_slow_db():
+        with sessionmaker(bind=sync_engine)() as db:
+            yield db
+    async def get_slow_async_db():
+        async with sessionmaker(bind=async_engine, class_=AsyncSession)() as db:
+            yield db
+    monkeypatch.setitem(app.dependency_overrides, database.get_read_db, get_slow_db)
+    monkeypatch.setitem(app.dependency_overrides, database.get_async_read_db, get_slow_async_db)
+    select_posts, aio_select_posts = post.select_posts, aio_post.select_posts
+    monkeypatch.setattr(post, "select_posts", lambda db: select_posts(db).filter(SLEEP))
+    monkeypatch.setattr(aio_post, "select_posts", lambda: aio_select_posts().filter(SLEEP))
+    timeouts = metrics.statement_timeouts_total.values[()]
+
+    res = authorised_client.get("/posts/")
+
+    assert res.status_code == 503
+    assert res.headers["Retry-After"] == "1"
+    assert metrics.statement_timeouts_total.values[()] == timeouts + 1
+
+
+def run_until_disconnect(asgi_app, scope=None, before_disconnect=None):
+    ''' Runs an ASGI app for a client that disconnects after sending its request, once before_disconnect returns '''
+    messages = [{"type": "http.request", "body": b"", "more_body": False}, {"type": "http.disconnect"}]
+    sent = []
+
+    async def receive():
+        if len(messages) == 1 and before_disconnect is not None:
+            await before_disconnect()
+        if messages:
+            return messages.pop(0)
+        await asyncio.Event().wait()
+
+    async def send(message):
+        sent.append(message)
+
+    scope = scope or {"type": "http", "method": "GET", "path": "/", "headers": []}
+    asyncio.run(asyncio.wait_for(asgi_app(scope, receive, send), timeout=5))
+    return sent
+
+# the fake path operations below never call receive, like FastAPI's for a route without a body
+
+def test_disconnect_cancels_async_request(monkeypatch):
+    monkeypatch.setattr(settings, "database_async", True)
+    async def endpoint(scope, receive, send):
+        await asyncio.sleep(10)
+
+    sent = run_until_disconnect(deadline.CancelOnDisconnectMiddleware(endpoint))
+    assert sent[0]["status"] == deadline.CLIENT_CLOSED_REQUEST
+
+def test_disconnect_cancels_sync_queries(monkeypatch):
+    monkeypatch.setattr(settings, "database_async", False)
+    class Connection:
+        cancelled = False
+        def cancel(self):
+            self.cancelled = True
+    connection = Connection()
+    started = asyncio.Event()
+
+    async def endpoint(scope, receive, send):
+        deadline.request_state.get().started(connection) # as if a query was running on it
+        started.set()
+        while not connection.cancelled:
+            await asyncio.sleep(0.01)
+
+    run_until_disconnect(deadline.CancelOnDisconnectMiddleware(endpoint), before_disconnect=started.wait)
+    assert connection.cancelled
+
+def test_disconnect_spares_finished_queries(monkeypatch):
+    # a connection whose statement has finished may already serve another request. It must not be cancelled
+    monkeypatch.setattr(settings, "database_async", False)
+    class Connection:
+        def cancel(self):
+            raise AssertionError("cancelled a connection the request no longer uses")
+    connection = Connection()
+    finished = asyncio.Event()
+
+    async def endpoint(scope, receive, send):
+        state = deadline.request_state.get()
+        state.started(connection)
+        state.finished(connection)
+        finished.set()
+        await asyncio.sleep(0.1)
+
+    run_until_disconnect(deadline.CancelOnDisconnectMiddleware(endpoint), before_disconnect=finished.wait)
+
+def test_disconnect_cancels_route_query(authorised_client, test_posts, session):
+    # GET /posts/ reads no body. Its query waits on a lock held by another connection until the client disconnects
+    session.commit() # let go of the posts read by the fixtures
+    locker = create_engine(SQL_ALCHEMY_DATABASE_URL, poolclass=NullPool).connect()
+    transaction = locker.begin()
+    # should the query not be cancelled, the server ends the locker's session so the test fails instead of hanging
+    locker.execute(text("SET LOCAL idle_in_transaction_session_timeout = '5s'"))
+    locker.execute(text("LOCK TABLE posts IN ACCESS EXCLUSIVE MODE"))
+
+    def lock_waiters():
+        return locker.execute(text("SELECT count(*) FROM pg_locks WHERE relation = 'posts'::regclass AND NOT granted")).scalar()
+
+    async def query_waiting():
+        while not await asyncio.get_running_loop().run_in_executor(None, lock_waiters):
+            await asyncio.sleep(0.01)
+
+    scope = {"type": "http", "http_version": "1.1", "method": "GET", "scheme": "http", "path": "/posts/", "raw_path": b"/posts/",
+             "root_path": "", "query_string": b"", "client": ("testclient", 50000), "server": ("testserver", 80),
+             "headers": [(b"authorization", authorised_client.headers["Authorization"].encode())]}
+    disconnects = metrics.client_disconnects_total.values[()]
+    try:
+        sent = run_until_disconnect(app, scope, before_disconnect=query_waiting)
+        # asyncpg sends its cancel request in the background
+        for _ in range(100):
+            if not lock_waiters():
+                break
+            time.sleep(0.01)
+        waiters = lock_waiters()
+    finally:
+        transaction.rollback()
+        locker.close()
+
+    assert sent[0]["status"] == deadline.CLIENT_CLOSED_REQUEST
+    assert waiters == 0 # the query was cancelled, not left waiting for the lock
+    assert metrics.client_disconnects_total.values[()] == disconnects + 1
@@ -0,0 +1,57 @@
+import pytest
+from sqlalchemy import delete, text
+from sqlalchemy.dialects import postgresql
+from app import models
+from app.routers.post import select_posts, delete_statement, update_statement
+from app.routers.vote import add_vote_statement, remove_vote_statement
+
+# The test tables are tiny, so the planner would rightly scan them. With sequential scans turned off
+# it picks an index whenever one can serve the query, which shows the queries the routers run can use their indexes
+
+
+def explain(session, query):
+    statement = getattr(query, "statement", query) # an ORM Query or a Core statement
+    sql = statement.compile(dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True})
+    session.execute(text("SET LOCAL enable_seqscan = off"))
+    return "\n".join(row[0] for row in session.execute(text(f"EXPLAIN {sql}")))
+
+
+@pytest.mark.parametrize("build_query, index", [
+    # /posts/page: newest first, seeking past the cursor
+    (lambda session: select_posts(session).order_by(models.Post.created_at.desc(), models.Post.id.desc()).limit(11),
+        "ix_posts_created_at_id"),
+    # /posts/{id}
+    (lambda session: select_posts(session).filter(models.Post.id == 1), "posts_pkey"),
+    # PUT /posts/{id} and DELETE /posts/{id}
+    (lambda session: update_statement(1, 1, {"title": "title"}), "posts_pkey"),
+    (lambda session: delete_statement(1, 1), "posts_pkey"),
+    # POST /vote/
+    (lambda session: add_vote_statement(1, 1), "posts_pkey"),
+    (lambda session: remove_vote_statement(1, 1), "votes_pkey"),
+])
+def test_queries_use_indexes(session, test_posts, build_query, index):
+    plan = explain(session, build_query(session))
+
+    assert index in plan # "Index Scan using <index>" or "Bitmap Index Scan on <index>"
+    assert "Seq Scan on posts" not in plan
+    assert "Seq Scan on votes" not in plan
+
+
+# No route looks posts up by owner_id, nor votes by post_id alone (votes_pkey covers (user_id, post_id)).
+# ix_posts_owner_id and ix_votes_post_id serve the ON DELETE CASCADE of the foreign keys: without them Postgres scans
+# the whole votes table for every deleted post, and the whole posts table for every deleted user.
+# The cascades run inside the DELETE and do not show in its EXPLAIN, so the scans of each index are counted instead
+@pytest.mark.parametrize("build_statement, index", [
+    # DELETE /posts/{id}: DELETE FROM votes WHERE post_id = $1
+    (lambda post: delete_statement(post.id, post.owner_id), "ix_votes_post_id"),
+    # deleting a user: DELETE FROM posts WHERE owner_id = $1
+    (lambda post: delete(models.User).where(models.User.id == post.owner_id), "ix_posts_owner_id"),
+])
+def test_cascades_use_indexes(session, test_posts, build_statement, index):
+    session.execute(text("SET LOCAL enable_seqscan = off"))
+    session.execute(text("DISCARD PLANS")) # the cascade's query may have been planned earlier on this connection
+    session.execute(build_statement(test_posts[0]))
+    scans = session.execute(text("SELECT pg_stat_get_xact_numscans(CAST(:index AS regclass))"), {"index": index}).scalar()
+    session.rollback()
+
+    assert scans > 0
@@ -0,0 +1,59 @@
+import threading
+from app import database
+
+
+def test_pool_metrics(client):
+    res = client.get("/metrics/pool")
+    pool = res.json()["primary"]
+
+    assert res.status_code == 200
+    assert pool["size"] == 5
+    assert pool["checked_out"] >= 0
+    assert pool["timeouts"] == 0
+
+
+def test_prometheus_metrics(authorised_client, test_posts):
+    authorised_client.get(f"/posts/{test_posts[0].id}")
+    res = authorised_client.get("/metrics")
+    body = res.text
+
+    assert res.status_code == 200
+    assert res.headers["content-type"].startswith("text/plain")
+    # labelled by the route template, not the requested path
+    assert 'http_requests_total{method="GET",route="/posts/{id}",status="200"}' in body
+    assert 'http_request_duration_seconds_bucket{method="GET",route="/posts/{id}",le="+Inf"}' in body
+    assert 'db_pool_size{engine="primary"} 5' in body
+    assert 'cache_misses_total{cache="posts"}' in body
+    assert "bcrypt_in_flight 0" in body
+
+
+def test_prometheus_metric_types(client):
+    body = client.get("/metrics").text
+    types = dict(line.split()[2:4] for line in body.splitlines() if line.startswith("# TYPE"))
+
+    # the _total suffix is reserved for counters
+    assert {name: kind for name, kind in types.items() if name.endswith("_total") and kind != "counter"} == {}
+    assert types["db_pool_checkouts_total"] == "counter"
+    assert types["db_pool_wait_seconds_total"] == "counter"
+    assert types["db_pool_checked_out"] == "gauge"
+
+
+def test_pool_metrics_threads():
+    # the sync engine updates the totals from many threadpool threads at once
+    pool_metrics = database.PoolMetrics()
+
+    def check_out_and_in():
+        for _ in range(10000):
+            pool_metrics.checked_out()
+            pool_metrics.waited(0.001, False)
+            pool_metrics.checked_in()
+
+    threads = [threading.Thread(target=check_out_and_in) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    totals = pool_metrics.snapshot()
+    assert totals["checkouts"] == totals["checkins"] == 80000
+    assert round(totals["wait_seconds_total"], 6) == 80.0
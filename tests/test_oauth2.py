@@ -0,0 +1,42 @@
+import time
+from datetime import datetime, timedelta
+import pytest
+from fastapi import HTTPException
+from app import oauth2
+
+credentials_exception = HTTPException(status_code=401)
+
+
+def test_verified_token_cached():
+    token = oauth2.create_access_token({"user_id": 1})
+    oauth2.token_cache.clear()
+
+    assert oauth2.verify_access_token(token, credentials_exception).id == "1"
+    assert oauth2.verify_access_token(token, credentials_exception).id == "1"
+    assert oauth2.token_cache.hits == 1
+
+def test_cached_token_expires_with_token():
+    # a token with a second left is only cached for that second
+    token = oauth2.encode_jwt({"user_id": 1, "exp": datetime.utcnow() + timedelta(seconds=1)})
+    oauth2.token_cache.clear()
+    oauth2.verify_access_token(token, credentials_exception)
+
+    time.sleep(2.1) # exp is whole seconds and a token is valid until the second after it
+    assert oauth2.token_cache.get(token) is None
+    with pytest.raises(HTTPException):
+        oauth2.verify_access_token(token, credentials_exception)
+
+def test_invalid_token_not_cached():
+    oauth2.token_cache.clear()
+    with pytest.raises(HTTPException):
+        oauth2.verify_access_token("not-a-token", credentials_exception)
+    assert len(oauth2.token_cache) == 0
+
+def test_jwt_backends_interchangeable():
+    pytest.importorskip("jwt")
+    claims = {"user_id": 1, "exp": datetime.utcnow() + timedelta(minutes=1)}
+
+    assert oauth2.pyjwt_decode(oauth2.jose_encode(claims))["user_id"] == 1
+    assert oauth2.jose_decode(oauth2.pyjwt_encode(claims))["user_id"] == 1
+    with pytest.raises(oauth2.JWTError):
+        oauth2.pyjwt_decode(oauth2.jose_encode(claims) + "x")
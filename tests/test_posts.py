@@ -1,5 +1,13 @@
+import csv
+import io
+import orjson
 import pytest
-from app import schemas
+import time
+from fastapi.encoders import jsonable_encoder
+from app import database, schemas
+from app.config import settings
+from app.cache import post_cache, post_tag
+from app.routers.post import post_dict
 from tests.conftest import authorised_client
 
 def test_get_all_posts(authorised_client, test_posts):
@@ -17,6 +25,108 @@ def test_get_all_posts(authorised_client, test_posts):
     assert len(res.json()) == len(test_posts)
     assert res.status_code == 200
 
+def test_get_posts_page(authorised_client, test_posts):
+    """
+    Test if an authenticated user is able to walk through all posts with cursor pagination
+    """
+    res = authorised_client.get("/posts/page?limit=3")
+    first_page = schemas.PostPage(**res.json())
+    assert res.status_code == 200
+    assert len(first_page.items) == 3
+    assert first_page.next_cursor is not None
+
+    res = authorised_client.get(f"/posts/page?limit=3&after={first_page.next_cursor}")
+    last_page = schemas.PostPage(**res.json())
+    assert res.status_code == 200
+    assert len(last_page.items) == 1
+    assert last_page.next_cursor is None
+
+    # every post is seen exactly once across the pages
+    post_ids = [item.Post.id for item in first_page.items + last_page.items]
+    assert sorted(post_ids) == sorted(post.id for post in test_posts)
+
+@pytest.mark.parametrize("path", ["/posts/", "/posts/page"])
+def test_get_posts_statements_independent_of_page_size(authorised_client, test_posts, statement_counter, path):
+    """
+    Test if owners are loaded with the posts rather than one query per owner (N+1)
+    """
+    counts = []
+    for limit in [1, 2, len(test_posts)]:
+        statement_counter.clear()
+        res = authorised_client.get(f"{path}?limit={limit}")
+        assert res.status_code == 200
+        counts.append(len(statement_counter))
+
+    assert counts == [1, 1, 1]
+
+def test_get_posts_page_invalid_cursor(authorised_client, test_posts):
+    res = authorised_client.get("/posts/page?after=not-a-cursor")
+    assert res.status_code == 400
+
+@pytest.mark.parametrize("search, expected_titles", [
+    ("first", ["first title"]),
+    ("3rd content", ["3rd title", "4th title"]),
+    ("nothing matches", []),
+])
+def test_search_posts(authorised_client, test_posts, search, expected_titles):
+    """
+    Test if a search matches the words in a post's title and content
+    """
+    res = authorised_client.get("/posts/", params={"search": search})
+    titles = [post['Post']['title'] for post in res.json()]
+
+    assert res.status_code == 200
+    assert sorted(titles) == expected_titles
+
+def test_get_all_posts_cached_until_post_created(authorised_client, test_posts):
+    """
+    Test if repeated listings are served from the cache and a new post shows up in the next listing
+    """
+    authorised_client.get("/posts/")
+    res = authorised_client.get("/posts/")
+    assert res.status_code == 200
+    assert len(res.json()) == len(test_posts)
+    assert post_cache.stats()["hits"] == 1
+
+    authorised_client.post("/posts/", json={"title": "arbitrary title", "content": "content"})
+    res = authorised_client.get("/posts/")
+    assert len(res.json()) == len(test_posts) + 1
+
+def test_post_fast_path_matches_schema(test_posts):
+    """
+    Test if the serialization fast path renders a post exactly as the PostResponse schema would
+    """
+    for post in test_posts:
+        expected = jsonable_encoder(schemas.PostResponse.from_orm(post))
+        assert orjson.loads(orjson.dumps(post_dict(post))) == expected
+
+@pytest.mark.parametrize("batch_size", [1, 1000])
+def test_export_posts_ndjson(authorised_client, test_posts, monkeypatch, batch_size):
+    """
+    Test if every post is streamed as one json line, whether it takes one batch or many
+    """
+    monkeypatch.setattr(settings, "export_batch_size", batch_size)
+    res = authorised_client.get("/posts/export")
+    rows = [orjson.loads(line) for line in res.text.splitlines()]
+
+    assert res.status_code == 200
+    assert res.headers["content-type"].startswith("application/x-ndjson")
+    assert [row["id"] for row in rows] == sorted(post.id for post in test_posts)
+    assert rows[0]["votes"] == 0
+
+def test_export_posts_csv(authorised_client, test_posts):
+    res = authorised_client.get("/posts/export?format=csv")
+    rows = list(csv.DictReader(io.StringIO(res.text)))
+
+    assert res.status_code == 200
+    assert res.headers["content-type"].startswith("text/csv")
+    assert len(rows) == len(test_posts)
+    assert {row["title"] for row in rows} == {post.title for post in test_posts}
+
+def test_unauthorised_user_export_posts(client, test_posts):
+    res = client.get("/posts/export")
+    assert res.status_code == 401
+
 def test_unauthorised_user_get_all_posts(client, test_posts):
     """
     Test if an unauthenticated user is unable to get all posts
@@ -48,6 +158,21 @@ def test_get_one_post(authorised_client, test_posts):
     assert post.Post.content == test_posts[0].content
     assert post.Post.title == test_posts[0].title
 
+def test_get_one_post_single_statement(authorised_client, test_posts, statement_counter):
+    """
+    Test if a post is fetched with one statement, then served from the cache with none
+    """
+    post_id = test_posts[0].id
+    statement_counter.clear()
+    res = authorised_client.get(f"/posts/{post_id}")
+    assert res.status_code == 200
+    assert len(statement_counter) == 1
+
+    statement_counter.clear()
+    res = authorised_client.get(f"/posts/{post_id}")
+    assert res.status_code == 200
+    assert statement_counter == []
+
 @pytest.mark.parametrize("title, content, published", [
     ("awesome new title", "awesome new content", True),
     ("well not so new title", "not so new content",  True),
@@ -76,6 +201,29 @@ def test_create_post_default_published_true(authorised_client, test_user, test_p
     assert created_post.published == True
     assert created_post.owner_id == test_user['id']
 
+def test_create_posts_bulk(authorised_client, test_user, test_posts, statement_counter):
+    posts = [{"title": f"bulk title {number}", "content": "bulk content", "published": number % 2 == 0} for number in range(5)]
+    statement_counter.clear()
+    res = authorised_client.post("/posts/bulk", json=posts)
+    created = [schemas.PostResponse(**post) for post in res.json()]
+
+    assert res.status_code == 201
+    assert len(statement_counter) == 1 # one INSERT ... RETURNING for all the posts and their owner
+    assert [post.title for post in created] == [post["title"] for post in posts]
+    assert [post.published for post in created] == [post["published"] for post in posts]
+    assert all(post.owner.email == test_user['email'] for post in created)
+    res = authorised_client.get("/posts/?limit=20")
+    assert len(res.json()) == len(test_posts) + len(posts)
+
+def test_create_posts_bulk_too_many(authorised_client, monkeypatch):
+    monkeypatch.setattr(settings, "post_bulk_max_size", 1)
+    res = authorised_client.post("/posts/bulk", json=[{"title": "a", "content": "b"}] * 2)
+    assert res.status_code == 413
+
+def test_unauthorised_user_create_posts_bulk(client):
+    res = client.post("/posts/bulk", json=[{"title": "a", "content": "b"}])
+    assert res.status_code == 401
+
 def test_unauthorised_user_create_post(client, test_posts):
     """
     Test if an unauthenticated user is able to create posts
@@ -126,6 +274,42 @@ def test_update_post(authorised_client, test_user, test_posts):
     assert updated_post.title == data['title']
     assert updated_post.content == data['content']
 
+def test_update_and_delete_post_single_statement(authorised_client, test_user, test_posts, statement_counter):
+    """
+    Test if the owner's update and delete are each one statement, with no SELECT before or after
+    """
+    post_id = test_posts[0].id
+    statement_counter.clear()
+    res = authorised_client.put(f"/posts/{post_id}", json={"title": "updated post", "content": "updated content"})
+    assert res.status_code == 200
+    assert res.json()['owner']['email'] == test_user['email']
+    assert len(statement_counter) == 1
+
+    statement_counter.clear()
+    res = authorised_client.delete(f"/posts/{post_id}")
+    assert res.status_code == 204
+    assert len(statement_counter) == 1
+
+def test_sticky_read_after_write_skips_cache(authorised_client, test_user, test_posts):
+    """
+    Test if a client which has just written is served its write, not an entry filled from a lagging replica after the write
+    """
+    post_id = test_posts[0].id
+    res = authorised_client.put(f"/posts/{post_id}", json={"title": "updated post", "content": "updated content"})
+    assert res.status_code == 200
+    # as a non sticky client reading a replica which has not caught up yet would have filled it
+    stale_body = authorised_client.get(f"/posts/{post_id}").content.replace(b"updated post", b"stale post")
+    post_cache.set(("post", post_id), stale_body, {post_tag(post_id)})
+
+    sticky = {database.PRIMARY_UNTIL_COOKIE: str(time.time() + 5)}
+    res = authorised_client.get(f"/posts/{post_id}", cookies=sticky)
+    assert res.json()['Post']['title'] == "updated post"
+    res = authorised_client.get("/posts/", cookies=sticky)
+    assert res.status_code == 200
+    # the sticky reads filled nothing either
+    assert post_cache.get(("post", post_id)) == stale_body
+    assert post_cache.get(("posts", 10, 0, "")) is None
+
 def test_update_other_user_post(authorised_client, test_user, test_user2, test_posts):
     """
     Test if a user is able to update another user's posts
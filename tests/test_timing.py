@@ -0,0 +1,23 @@
+import re
+from app import timing
+
+
+def test_server_timing_header(authorised_client, test_posts):
+    """
+    Test if a response breaks the request down into phases and counts its sql statements
+    """
+    res = authorised_client.get("/posts/")
+    server_timing = res.headers["Server-Timing"]
+
+    assert res.status_code == 200
+    for phase in ["auth", "db", "handler", "serialization", "total"]:
+        assert f"{phase};dur=" in server_timing
+    statements = int(re.search(r'db_statements;desc="(\d+) statements"', server_timing).group(1))
+    assert statements >= 1
+
+def test_repeated_statements_flagged():
+    timings = timing.RequestTimings()
+    timings.statements["SELECT users.id FROM users WHERE users.id = %(pk_1)s"] += 10
+    timings.statements["SELECT posts.id FROM posts"] += 1
+
+    assert list(timings.repeated_statements()) == ["SELECT users.id FROM users WHERE users.id = %(pk_1)s"]
@@ -9,6 +9,7 @@
 
 import pytest
 from jose import jwt
+from sqlalchemy import text
 from app import schemas 
 from app.config import settings
 
@@ -60,4 +61,60 @@ def test_incorrect_login(test_user, client, email, password, status_code):
     assert res.status_code == status_code
     # assert res.json().get('detail') == 'Invalid Credentials'  # Since 'Invalid Credentials' response won't apply when the server response is a 422 error
 
- 
\ No newline at end of file
+ 
+def test_export_users_csv(client, test_user, test_user2):
+    res = client.get("/users/export?format=csv")
+    lines = res.text.splitlines()
+
+    assert res.status_code == 200
+    assert lines[0] == "id,email,created_at"
+    assert [line.split(",")[1] for line in lines[1:]] == [test_user['email'], test_user2['email']]
+    assert "password" not in res.text
+
+def test_get_users_pages(client, test_user, test_user2):
+    res = client.get("/users/?limit=1")
+    first_page = res.json()
+    assert res.status_code == 200
+    assert [user['email'] for user in first_page] == [test_user['email']]
+
+    res = client.get(f"/users/?limit=1&after={first_page[-1]['id']}")
+    assert [user['email'] for user in res.json()] == [test_user2['email']]
+
+    res = client.get(f"/users/?limit=1&after={test_user2['id']}")
+    assert res.json() == []
+
+def test_get_users_limit_capped(client, test_user, monkeypatch):
+    monkeypatch.setattr(settings, "users_page_max_size", 1)
+    client.post("/users/", json={"email": "another@gmail.com", "password": "password123"})
+    res = client.get("/users/?limit=1000")
+    assert len(res.json()) == 1
+
+def test_count_users(client, test_user, test_user2):
+    # a freshly created table has no planner estimate yet, so the users are counted
+    res = client.get("/users/count")
+    assert res.status_code == 200
+    assert res.json() == {"count": 2, "estimated": False}
+
+def test_count_users_estimated(client, test_user, test_user2, session):
+    session.execute(text("ANALYZE users"))
+    session.commit()
+    res = client.get("/users/count")
+    assert res.json() == {"count": 2, "estimated": True}
+
+def test_get_me(authorised_client, test_user, statement_counter):
+    """
+    Test if the user's own row is looked up once, then served from the cache of users' rows
+    """
+    res = authorised_client.get("/users/me")
+    assert res.status_code == 200
+    assert res.json()['email'] == test_user['email']
+    assert [statement for statement in statement_counter if "FROM users" in statement] != []
+
+    statement_counter.clear()
+    res = authorised_client.get("/users/me")
+    assert res.json()['id'] == test_user['id']
+    assert [statement for statement in statement_counter if "FROM users" in statement] == []
+
+def test_get_me_unauthorised(client, test_user):
+    res = client.get("/users/me")
+    assert res.status_code == 401
@@ -0,0 +1,32 @@
+import threading
+import pytest
+from fastapi import HTTPException
+from app import utils
+
+
+def test_hash_and_verify_password():
+    hashed_password = utils.hash("password123")
+
+    assert hashed_password != "password123"
+    assert utils.verify("password123", hashed_password)
+    assert not utils.verify("wrongpassword", hashed_password)
+
+def test_bounded_executor_rejects_when_full():
+    executor = utils.BoundedExecutor(max_workers=1, max_queue=1)
+    release = threading.Event()
+    # one call runs and one waits in the queue
+    running = executor.submit(release.wait)
+    queued = executor.submit(release.wait)
+
+    with pytest.raises(HTTPException) as error:
+        executor.submit(release.wait)
+    assert error.value.status_code == 503
+    assert executor.rejected == 1
+    assert executor.in_flight == 2
+
+    release.set()
+    running.result()
+    queued.result()
+    # slots are freed once calls complete
+    assert executor.run(lambda: "done") == "done"
+    assert executor.in_flight == 0
@@ -1,5 +1,10 @@
 import pytest   
-from app import models
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import event
+from app import models, schemas
+from app.routers import vote
+from tests.conftest import engine, TestingSessionLocal
 
 # test_vote_on_post is the case of a user voting on their own post
 # since as per current design, the app allows for it.
@@ -32,8 +37,32 @@ def test_vote(test_posts, session, test_user):
     # vote on the 4th post by adding vote to the database directly 
     new_vote = models.Vote(post_id=test_posts[3].id, user_id=test_user['id'])
     session.add(new_vote)
+    # the vote router keeps each post's vote_count in step with its votes. Do the same here
+    test_posts[3].vote_count += 1
     session.commit()
 
+def test_vote_updates_vote_count(authorised_client, test_posts):
+    # Test that adding then deleting a vote is reflected in the post's vote count
+    post_id = test_posts[0].id
+    res = authorised_client.post("/vote/", json={"post_id": post_id, "dir":1})
+    assert res.status_code == 201
+    res = authorised_client.get(f"/posts/{post_id}")
+    assert res.json()['votes'] == 1
+
+    res = authorised_client.post("/vote/", json={"post_id": post_id, "dir":0})
+    assert res.status_code == 201
+    res = authorised_client.get(f"/posts/{post_id}")
+    assert res.json()['votes'] == 0
+
+def test_vote_single_statement(authorised_client, test_posts, statement_counter):
+    # Test that a vote and the post's vote count are written in one statement (plus the commit)
+    # and that the user is not looked up: the user id comes from the token
+    post_id = test_posts[0].id
+    statement_counter.clear()
+    res = authorised_client.post("/vote/", json={"post_id": post_id, "dir":1})
+    assert res.status_code == 201
+    assert len(statement_counter) == 1
+
 def test_vote_twice_post(authorised_client, test_posts, test_vote):
     # Test users ability to vote twice (in the same direction) on the same post
     res = authorised_client.post("/vote/", json={"post_id": test_posts[3].id, "dir":1})
@@ -54,8 +83,85 @@ def test_vote_non_exist_post(authorised_client, test_vote):
     # Test users ability to vote a non existent post 
     res = authorised_client.post("/vote/", json={"post_id": 80000, "dir":1})
     assert res.status_code == 404
+    assert res.json()['detail'] == "Post with id: 80000 does not exist"
 
 def test_vote_unauthorised(client, test_posts):
     # Test unauthorised users ability to vote on a post
     res = client.post("/vote/", json={"post_id": test_posts[3].id, "dir":1})
-    assert res.status_code == 401
\ No newline at end of file
+    assert res.status_code == 401
+
+
+def test_vote_batch(authorised_client, test_posts, test_vote):
+    # Test that every vote of a batch gets its own result, in order
+    votes = [
+        {"post_id": test_posts[0].id, "dir": 1}, # added
+        {"post_id": test_posts[3].id, "dir": 1}, # already voted by test_vote
+        {"post_id": 80000, "dir": 1},             # no such post
+        {"post_id": test_posts[1].id, "dir": 0}, # no vote to delete
+        {"post_id": test_posts[0].id, "dir": 0}, # same post again: the vote just added is deleted
+    ]
+    post_id = test_posts[0].id
+    res = authorised_client.post("/vote/batch", json=votes)
+
+    assert res.status_code == 200
+    assert [result['status_code'] for result in res.json()] == [201, 409, 404, 404, 201]
+    res = authorised_client.get(f"/posts/{post_id}")
+    assert res.json()['votes'] == 0
+
+def test_vote_batch_in_order(authorised_client, test_posts, test_vote):
+    # Test that the votes on one post are applied in order, as separate calls to /vote/ would be
+    post_id = test_posts[3].id # already voted by test_vote
+    votes = [{"post_id": post_id, "dir": direction} for direction in (1, 0, 0, 1)]
+    res = authorised_client.post("/vote/batch", json=votes)
+
+    assert [result['status_code'] for result in res.json()] == [409, 201, 404, 201]
+    assert [result['detail'] for result in res.json()][1:3] == ["successfully deleted vote", "Vote does not exist"]
+    res = authorised_client.get(f"/posts/{post_id}")
+    assert res.json()['votes'] == 1
+
+def test_vote_batch_delete(authorised_client, test_posts, test_vote):
+    post_id = test_posts[3].id
+    res = authorised_client.post("/vote/batch", json=[{"post_id": post_id, "dir": 0}])
+
+    assert res.status_code == 200
+    assert res.json()[0]['detail'] == "successfully deleted vote"
+    res = authorised_client.get(f"/posts/{post_id}")
+    assert res.json()['votes'] == 0
+
+def test_concurrent_vote_batches(test_posts, test_user, test_user2, session):
+    # Test that two batches touching the same posts in opposite orders both go through instead of deadlocking.
+    # Each transaction waits (up to a second) for the other to run its first statement before running its second
+    first, second = test_posts[0].id, test_posts[3].id
+    session.add_all([models.Vote(post_id=second, user_id=test_user['id']), models.Vote(post_id=first, user_id=test_user2['id'])])
+    session.commit()
+    batches = [
+        (test_user['id'], [schemas.Vote(post_id=first, dir=1), schemas.Vote(post_id=second, dir=0)]),
+        (test_user2['id'], [schemas.Vote(post_id=second, dir=1), schemas.Vote(post_id=first, dir=0)]),
+    ]
+    barrier = threading.Barrier(len(batches), timeout=1)
+    statements = threading.local()
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.count = getattr(statements, "count", 0) + 1
+        if statements.count == 2:
+            try:
+                barrier.wait()
+            except threading.BrokenBarrierError:
+                pass # the other transaction is waiting on a lock this one holds
+
+    def send_batch(user_id, votes):
+        with TestingSessionLocal() as db:
+            return vote.vote_batch(votes, db, schemas.Principal(id=user_id))
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        with ThreadPoolExecutor(max_workers=len(batches)) as executor:
+            results = list(executor.map(lambda batch: send_batch(*batch), batches))
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+    assert [[result['status_code'] for result in batch] for batch in results] == [[201, 201], [201, 201]]
+
+def test_vote_batch_unauthorised(client, test_posts):
+    res = client.post("/vote/batch", json=[{"post_id": test_posts[3].id, "dir":1}])
+    assert res.status_code == 401